@@ -0,0 +1,37 @@
+import os
+from functools import lru_cache
+from typing import Union
+
+
+@lru_cache(maxsize=None)
+def get_setting(name: str) -> Union[str, None]:
+    """
+    Read a setting from the environment, once.
+
+    The settings are read on first use and not at import, so that the values
+    loaded after importing kbgit (e.g. with `load_dotenv()`) are taken into
+    account. Empty values are treated as unset.
+
+    Args:
+        name (str): The name of the environment variable.
+
+    Returns:
+        Union[str, None]: The value of the setting, or None if it is not set.
+    """
+    return os.getenv(name) or None
+
+
+def compute_parallelism() -> int:
+    """
+    Maximum number of KBBs computed concurrently by each KBB (for its parents)
+    and by each KBD, set with KBGIT_COMPUTE_PARALLELISM. Defaults to 8.
+    """
+    return int(get_setting("KBGIT_COMPUTE_PARALLELISM") or 8)
+
+
+def embedding_output_size() -> int:
+    """
+    Size of the placeholder embeddings (of empty texts and of the KBBs not
+    computed yet), set with EMBEDDING_OUTPUT_SIZE. Defaults to 1.
+    """
+    return int(get_setting("EMBEDDING_OUTPUT_SIZE") or 1)
@@ -1,15 +1,199 @@
 import os
-from chromadb import HttpClient # type: ignore
-from chromadb.utils.embedding_functions import ( # type: ignore
-    OpenAIEmbeddingFunction
-)
+import sys
+import asyncio
+from chromadb import HttpClient, AsyncHttpClient # type: ignore
+import orjson
 from ast import literal_eval
-from copy import deepcopy
-from typing import List, Any
+import numpy as np
+from functools import lru_cache
+from threading import local
+from typing import List, Any, Union
 from ..log import logger
 from .db import DatabaseConnection
 
 
+# KBD, KBN and OP collections are only used as key-value stores of metadata: 
+# their placeholder embeddings are never queried, so the HNSW index 
+# maintenance is deferred as much as possible.
+METADATA_ONLY_COLLECTION = {
+    "hnsw:batch_size": 10000,
+    "hnsw:sync_threshold": 100000,
+}
+
+
+# From this number of requested results on, KBB queries first fetch only the 
+# distances, and then the data of the KBBs within the distance threshold.
+TWO_PASS_QUERY_MIN_RESULTS = 50
+
+
+def kbb_where_clause(kbb_ids_to_query: Union[List[str], set, None]) -> Union[dict, None]:
+    """
+    Build the Chroma `where` clause restricting a query to the given KBB IDs.
+
+    Args:
+        kbb_ids_to_query (list, set or None): The KBB IDs.
+
+    Returns:
+        dict or None: The `where` clause, or None if no KBB ID is given.
+    """
+    if not kbb_ids_to_query:
+        return None
+    return {"kbb_id": {"$in": list(kbb_ids_to_query)}}
+
+
+def _loads(value: str) -> Any:
+    """
+    Decode a list stored in the metadata of a KBD or KBB entry.
+
+    The lists are stored as JSON. The entries written by the earlier versions 
+    of kbgit stored them with `str()`, so they are decoded with 
+    `literal_eval` when they are not valid JSON.
+
+    Args:
+        value (str): The stored list.
+
+    Returns:
+        Any: The decoded list.
+    """
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        return literal_eval(value)
+
+
+def _encode_kbb_metadata(kbb_data: dict) -> dict:
+    """
+    Convert the data of a KBB into a Chroma metadata dictionary.
+
+    Values that Chroma metadata supports natively (str, int, float and bool) 
+    are stored as they are, the list of parents is serialized to JSON and any 
+    other value is converted to a string.
+
+    Args:
+        kbb_data (dict): The data of the KBB.
+
+    Returns:
+        dict: The metadata to be stored in the KBB collection.
+    """
+    metadata = {}
+    for key, value in kbb_data.items():
+        if key == "embedding":
+            continue
+        if key == "parents_kbb":
+            metadata[key] = orjson.dumps(value).decode()
+        elif isinstance(value, (str, int, float)):
+            metadata[key] = value
+        else:
+            metadata[key] = str(value)
+    return metadata
+
+
+def _decode_kbb_metadata(metadata: dict) -> dict:
+    """
+    Convert a Chroma metadata dictionary back into the data of a KBB.
+
+    The metadata dictionaries of a query result are not shared with anything 
+    else, so they are decoded in place instead of being copied.
+
+    Args:
+        metadata (dict): The metadata stored in the KBB collection.
+
+    Returns:
+        dict: The data of the KBB, without the embedding.
+    """
+    metadata["parents_kbb"] = _loads(metadata["parents_kbb"])
+    for parent in metadata["parents_kbb"]:
+        if "kbb_id" in parent:
+            parent["kbb_id"] = sys.intern(parent["kbb_id"])
+    return metadata
+
+
+def _kbb_records(kbbs: List[Any]) -> dict:
+    """
+    Build the parallel lists needed to add several KBBs to the KBB collection.
+
+    Embeddings may be given either as lists or as NumPy arrays. When they are 
+    all arrays of the same shape, they are stacked and converted to lists with 
+    a single call, otherwise they are converted one by one.
+
+    Args:
+        kbbs (List[KBB]): The KBB objects containing the data to be added.
+
+    Returns:
+        dict: The ids, documents, embeddings and metadatas of the KBBs.
+    """
+    records: dict = {
+        "ids": [], 
+        "documents": [], 
+        "embeddings": [], 
+        "metadatas": []
+    }
+    for kbb in kbbs:
+        records["ids"].append(kbb.data["kbb_id"])
+        records["documents"].append(kbb.data["content"])
+        records["embeddings"].append(kbb.data["embedding"])
+        records["metadatas"].append(_encode_kbb_metadata(kbb.data))
+    embeddings = records["embeddings"]
+    if all(isinstance(_, np.ndarray) for _ in embeddings) and \
+        len({_.shape for _ in embeddings}) == 1:
+        records["embeddings"] = np.stack(embeddings).tolist()
+    else:
+        records["embeddings"] = [
+            _.tolist() if isinstance(_, np.ndarray) else _ for _ in embeddings
+        ]
+    return records
+
+
+def _query_include(include_embeddings: bool) -> list:
+    """
+    Return the fields to be included in the results of a KBB query.
+
+    Args:
+        include_embeddings (bool): Whether to include the embeddings.
+
+    Returns:
+        list: The list of fields to pass to `collection.query`.
+    """
+    include = ["metadatas", "distances"]
+    if include_embeddings:
+        include.append("embeddings")
+    return include
+
+
+def _filter_query_results(results: dict, i: int, distance: float) -> list:
+    """
+    Decode the KBBs returned by a query, keeping only the close enough ones.
+
+    Args:
+        results (dict): The results of a query on the KBB collection.
+        i (int): The index of the query embedding in the results.
+        distance (float): The maximum distance allowable for an entry to be 
+            considered a match.
+
+    Returns:
+        list: A list of tuples, each containing the distance to the matching 
+            KBB entry and the corresponding KBB entry, sorted by distance.
+    """
+    distances = np.asarray(results["distances"][i])
+    idx = np.where(distances <= distance)[0]
+    if len(idx) > 0:
+        order = idx[np.argsort(distances[idx], kind="stable")]
+        metadatas = results["metadatas"][i]
+        embeddings = results["embeddings"][i] \
+            if results.get("embeddings") is not None else None
+        list_output = []
+        for _ in order:
+            kbb_data = _decode_kbb_metadata(metadatas[_])
+            if embeddings is not None:
+                kbb_data["embedding"] = embeddings[_]
+            list_output.append((float(distances[_]), kbb_data))
+        logger.debug(f"Found {len(list_output)} KBBs.")
+        return list_output
+    else:
+        logger.debug(f"Found 0 KBB.")
+        return []
+
+
 class ChromaDBConnection(DatabaseConnection):
     """
     ChromaDBConnection class to interface with a Chroma database.
@@ -20,46 +204,102 @@ class ChromaDBConnection(DatabaseConnection):
     It establishes a connection to the Chroma database.
     """
 
-    def __init__(self):
+    def __init__(self, flush_threshold: int = 128):
         """
         Initialize the ChromaDBConnection instance.
 
         This constructor creates an HttpClient to connect to the Chroma 
         database using the host and port specified in environment variables. 
-        It also initializes the OpenAI embedding function for generating text 
-        embeddings. Additionally, it ensures that the KBD, KBN and KBB 
-        collections exist in the database.
+        Additionally, it ensures that the KBD, KBN, KBB and OP collections 
+        exist in the database. The OpenAI embedding function is initialized 
+        only when the first text search is made.
+
+        Args:
+            flush_threshold (int, optional): The number of buffered KBBs that 
+                triggers a flush when the connection is used in buffered mode. 
+                Defaults to 128.
         """
         self.client = HttpClient(
             host=os.getenv('CHROMA_DB_HOST'), 
             port=os.getenv('CHROMA_DB_PORT')
         )
-        self.embedding_function = OpenAIEmbeddingFunction(
-            api_key=os.getenv('OPENAI_API_KEY'), 
-            model_name=os.getenv('CHROMA_EMBEDDING_MODEL')
+        self._embedding_function = None
+        self._embed = lru_cache(maxsize=4096)(self._embed_text)
+        self._kbd_collection = self.client.get_or_create_collection(
+            "KBD", metadata=METADATA_ONLY_COLLECTION
+        )
+        self._kbn_collection = self.client.get_or_create_collection(
+            "KBN", metadata=METADATA_ONLY_COLLECTION
         )
-        self.kbd_create_collection_if_not_exists()
-        self.kbn_create_collection_if_not_exists()
-        self.kbb_create_collection_if_not_exists()
+        self._kbb_collection = self.client.get_or_create_collection("KBB")
+        self._op_collection = self.client.get_or_create_collection(
+            "OP", metadata=METADATA_ONLY_COLLECTION
+        )
+        self.flush_threshold = flush_threshold
+        # The connection is shared by the whole process, so the buffered 
+        # mode (and its buffer) is kept per thread.
+        self._local = local()
         logger.debug("ChromaDB client ready.")
 
-    '''KBD'''
+    @property
+    def embedding_function(self) -> Any:
+        """
+        Return the OpenAI embedding function, initializing it on first use.
+        """
+        if self._embedding_function is None:
+            from chromadb.utils.embedding_functions import ( # type: ignore
+                OpenAIEmbeddingFunction
+            )
+            self._embedding_function = OpenAIEmbeddingFunction(
+                api_key=os.getenv('OPENAI_API_KEY'), 
+                model_name=os.getenv('CHROMA_EMBEDDING_MODEL')
+            )
+        return self._embedding_function
+
+    def _kbb_buffer(self) -> List[Any]:
+        """
+        Return the list of the KBBs buffered by the current thread.
+        """
+        if not hasattr(self._local, "kbb_buffer"):
+            self._local.kbb_buffer = []
+            self._local.depth = 0
+        return self._local.kbb_buffer
 
-    def kbd_exists_collection(self) -> bool:
+    def __enter__(self) -> "ChromaDBConnection":
         """
-        Check if the KBD collection exists in the database.
+        Enter the buffered-write mode, for the current thread only.
+
+        While in this mode, `kbb_create` accumulates KBBs and adds them to the 
+        KBB collection in batches of `flush_threshold` entries. The `with` 
+        blocks can be nested: the mode ends with the outermost one.
 
         Returns:
-            bool: True if the KBD collection exists, False otherwise.
+            ChromaDBConnection: The connection itself.
+        """
+        self._kbb_buffer()
+        self._local.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
         """
-        return "KBD" in [_.name for _ in self.client.list_collections()]
+        Leave the buffered-write mode, flushing the pending KBBs when the 
+        outermost `with` block exits.
+        """
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            self.flush()
 
-    def kbd_create_collection(self):
+    def flush(self):
         """
-        Create a new KBD collection in the database.
+        Add all the KBBs buffered by the current thread to the KBB collection 
+        with a single call.
         """
-        self.client.create_collection("KBD")
-        logger.debug(f"Collection KBD created.")
+        kbbs = self._kbb_buffer()
+        if len(kbbs) > 0:
+            self._local.kbb_buffer = []
+            self.kbb_create_many(kbbs)
+
+    '''KBD'''
 
     def kbd_update(self, kbd: Any):
         """
@@ -71,18 +311,15 @@ class ChromaDBConnection(DatabaseConnection):
         Args:
             kbd: The KBD object containing the data to be updated.
         """
-        collection = self.client.get_collection("KBD")
-        kbd = deepcopy(kbd)
-        del kbd.data["kbbs"]
-        kbd.data["operations"] = str(kbd.data["operations"])
-        kbd.data["kbb_ids"] = str(kbd.data["kbb_ids"])
-        collection.upsert(
-            ids=[kbd.data["kbd_id"]], 
-            documents=[""],
+        data = {k: v for k, v in kbd.data.items() if k != "kbbs"}
+        data["operations"] = orjson.dumps(data["operations"]).decode()
+        data["kbb_ids"] = orjson.dumps(data["kbb_ids"]).decode()
+        self._kbd_collection.upsert(
+            ids=[data["kbd_id"]], 
             embeddings=[[0]],
-            metadatas=[kbd.data]
+            metadatas=[data]
         )
-        logger.debug(f"KBD {kbd.data['kbd_id']} updated.")
+        logger.debug(f"KBD {data['kbd_id']} updated.")
 
     def kbd_search_by_id(self, kbd_id: str) -> dict:
         """
@@ -95,8 +332,7 @@ class ChromaDBConnection(DatabaseConnection):
             dict: The KBD entry's metadata if found, 
                 otherwise an empty dictionary.
         """
-        collection = self.client.get_collection("KBD")
-        results = collection.get(
+        results = self._kbd_collection.get(
             ids=[kbd_id],
             include=['metadatas']
         )
@@ -104,29 +340,35 @@ class ChromaDBConnection(DatabaseConnection):
             logger.debug(f"KBD {kbd_id} found.")
             output = results["metadatas"][0]
             output["kbd_id"] = kbd_id
-            output["kbb_ids"] = literal_eval(output["kbb_ids"])
-            output["operations"] = literal_eval(output["operations"])
+            output["kbb_ids"] = _loads(output["kbb_ids"])
+            output["operations"] = _loads(output["operations"])
             return output
         logger.debug(f"KBD {kbd_id} not found.")
         return {}
 
     '''KBN'''
 
-    def kbn_exists_collection(self) -> bool:
+    def _kbn_add_kbb(self, kbn_id: str, kbb_id: str, kbb_tms: float):
         """
-        Check if the KBN collection exists in the database.
+        Store the association between a KBN entry and one of its KBBs.
 
-        Returns:
-            bool: True if the KBN collection exists, False otherwise.
-        """
-        return "KBN" in [_.name for _ in self.client.list_collections()]
+        Each KBB of a KBN is stored as a separate record keyed by 
+        `{kbn_id}:{kbb_id}`, so that appending a KBB to a KBN is a single 
+        write, without reading or rewriting the whole KBN entry. The last KBB 
+        of the KBN is derived from these records when it is requested, so 
+        concurrent writers (even from different processes) cannot lose an 
+        update.
 
-    def kbn_create_collection(self):
+        Args:
+            kbn_id (str): The ID of the KBN entry.
+            kbb_id (str): The ID of the KBB.
+            kbb_tms (float): The timestamp of the KBB.
         """
-        Create a new KBN collection in the database.
-        """        
-        self.client.create_collection("KBN")
-        logger.debug(f"Collection KBN created.")
+        self._kbn_collection.upsert(
+            ids=[f"{kbn_id}:{kbb_id}"], 
+            embeddings=[[0]],
+            metadatas=[{"kbn_id": kbn_id, "kbb_id": kbb_id, "tms": kbb_tms}],
+        )
 
     def kbn_create(self, kbn_id: str, kbb_id: str, kbb_tms: float):
         """
@@ -137,13 +379,7 @@ class ChromaDBConnection(DatabaseConnection):
             kbb_id: The ID of the associated KBB.
             kbb_tms: The timestamp of the associated KBB.
         """
-        collection = self.client.get_collection("KBN")
-        collection.add(
-            ids=[kbn_id], 
-            documents=[""],
-            embeddings=[[0]],
-            metadatas=[{kbb_id: kbb_tms}],
-        )
+        self._kbn_add_kbb(kbn_id=kbn_id, kbb_id=kbb_id, kbb_tms=kbb_tms)
         logger.debug(f"KBN {kbn_id} created with one KBB {kbb_id} computed at {kbb_tms}.")
 
     def kbn_search_by_id(self, kbn_id: str) -> dict:
@@ -153,18 +389,35 @@ class ChromaDBConnection(DatabaseConnection):
         Args:
             kbn_id (str): The ID of the KBN entry to be searched.
 
+        The KBNs written by the earlier versions of kbgit are a single record 
+        keyed by `kbn_id`, mapping the IDs of their KBBs to their timestamps. 
+        This record is read too, and merged with the per-KBB records of the 
+        KBBs added since then.
+
         Returns:
-            dict: The KBN entry's metadata if found, 
+            dict: A dictionary mapping the IDs of the KBBs of the KBN entry to 
+                their timestamps, ordered by timestamp, if found, 
                 otherwise an empty dictionary.
         """
-        collection = self.client.get_collection("KBN")
-        results = collection.get(
+        results = self._kbn_collection.get(
+            where={"kbn_id": kbn_id},
+            include=['metadatas']
+        )
+        dict_kbbs = {
+            metadata["kbb_id"]: float(metadata["tms"]) 
+            for metadata in results["metadatas"]
+        }
+        legacy_results = self._kbn_collection.get(
             ids=[kbn_id],
             include=['metadatas']
         )
-        if len(results["ids"]) > 0:
+        for metadata in legacy_results["metadatas"]:
+            for kbb_id, kbb_tms in metadata.items():
+                if kbb_id.startswith("kbb_"):
+                    dict_kbbs.setdefault(kbb_id, float(kbb_tms))
+        if len(dict_kbbs) > 0:
             logger.debug(f"KBN {kbn_id} found.")
-            return results["metadatas"][0]
+            return dict(sorted(dict_kbbs.items(), key=lambda item: item[1]))
         logger.debug(f"KBN {kbn_id} not found.")
         return {}
 
@@ -172,21 +425,16 @@ class ChromaDBConnection(DatabaseConnection):
         """
         Add a new KBB entry to an existing KBN entry.
 
-        This method retrieves the current metadata of the KBN entry 
-        and updates it with a new KBB ID and timestamp.
+        The new KBB is stored as a separate record of the KBN collection, 
+        without reading or rewriting the existing KBN entry.
 
         Args:
             kbn_id (str): The ID of the KBN entry to be updated.
             kbb_id (str): The ID of the new KBB to add.
             kbb_tms (float): The timestamp of the new KBB.
         """
-        old_metadatas = self.kbn_search_by_id(kbn_id)
-        new_metadata = {**old_metadatas, kbb_id: kbb_tms}
-        collection = self.client.get_collection("KBN")
-        collection.update(
-            ids=[kbn_id],
-            metadatas=[new_metadata]
-        )
+        self._kbn_add_kbb(kbn_id=kbn_id, kbb_id=kbb_id, kbb_tms=kbb_tms)
+        logger.debug(f"KBB {kbb_id} added to KBN {kbn_id}.")
 
     def kbn_get_last_kbb_id(self, kbn_id: str) -> str:
         """
@@ -202,46 +450,45 @@ class ChromaDBConnection(DatabaseConnection):
             str: The ID of the last KBB entry associated with the given KBN.
         """
         dict_kbbs = self.kbn_search_by_id(kbn_id)
-        if len(dict_kbbs):
-            max_key = max(dict_kbbs, key=lambda k: float(str(dict_kbbs.get(k))))
-            return max_key
+        if len(dict_kbbs) > 0:
+            return next(reversed(dict_kbbs))
         return ""
 
     '''KBB'''
 
-    def kbb_exists_collection(self) -> bool:
-        """
-        Check if the KBB collection exists in the database.
-
-        Returns:
-            bool: True if the KBB collection exists, False otherwise.
-        """
-        return "KBB" in [_.name for _ in self.client.list_collections()]
-
-    def kbb_create_collection(self):
-        """
-        Create a new KBB collection in the database.
-        """
-        self.client.create_collection("KBB")
-        logger.debug(f"Collection KBB created.")
-
     def kbb_create(self, kbb: Any):
         """Add a new KBB entry to the KBB collection.
 
         This method adds a KBB entry, including its content and associated 
         metadata to the KBB collection in the database.
 
+        In buffered mode the KBB is only queued, and it is added together with 
+        the other KBBs buffered by the same thread once `flush_threshold` is 
+        reached or when `flush` is called.
+
         Args:
             kbb (KBB): The KBB object containing the data to be added.
         """
-        collection = self.client.get_collection("KBB")
-        collection.add(
-            ids=[kbb.data["kbb_id"]], 
-            documents=[kbb.data["content"]],
-            embeddings=[kbb.data["embedding"]],
-            metadatas=[{key: str(value) for key, value in kbb.data.items() if key not in ["embedding"]}],
-        )
-        logger.debug(f"{kbb.data['kbb_id']} added.")
+        kbbs = self._kbb_buffer()
+        if self._local.depth > 0:
+            kbbs.append(kbb)
+            logger.debug(f"{kbb.data['kbb_id']} buffered.")
+            if len(kbbs) >= self.flush_threshold:
+                self.flush()
+            return
+        self.kbb_create_many([kbb])
+
+    def kbb_create_many(self, kbbs: List[Any]):
+        """
+        Add several KBB entries to the KBB collection with a single call.
+
+        Args:
+            kbbs (List[KBB]): The KBB objects containing the data to be added.
+        """
+        if len(kbbs) == 0:
+            return
+        self._kbb_collection.add(**_kbb_records(kbbs))
+        logger.debug(f"{len(kbbs)} KBBs added.")
     
     def kbb_search_by_id(self, kbb_id: str) -> dict:
         """
@@ -253,27 +500,84 @@ class ChromaDBConnection(DatabaseConnection):
         Returns:
             dict: The KBB entry's data if found, otherwise an empty dictionary.
         """
-        collection = self.client.get_collection("KBB")
-        results = collection.get(
+        self.flush()
+        results = self._kbb_collection.get(
             ids=[kbb_id],
-            include=['embeddings', 'documents', 'metadatas']
+            include=['embeddings', 'metadatas']
         )
         if len(results["ids"]) > 0:
-            kbb_data = results["metadatas"][0].copy()
+            kbb_data = _decode_kbb_metadata(results["metadatas"][0])
             kbb_data["embedding"] = results["embeddings"][0]
-            kbb_data["parents_kbb"] = literal_eval(kbb_data["parents_kbb"])
-            kbb_data["tms_create"] = float(kbb_data["tms_create"])
-            kbb_data["tms_compute"] = float(kbb_data["tms_compute"])
             return kbb_data
         logger.debug(f"KBB {kbb_id} not found")
         return {}
 
+    def kbb_embedding_by_hash(self, content_hash: str) -> Union[list, None]:
+        """
+        Search for the embedding of a KBB entry by the hash of its content.
+
+        Args:
+            content_hash (str): The SHA-256 hash of the KBB content.
+
+        Returns:
+            list or None: The embedding of a KBB entry with the given content 
+                hash if found, otherwise None.
+        """
+        self.flush()
+        results = self._kbb_collection.get(
+            where={"content_hash": content_hash},
+            limit=1,
+            include=['embeddings']
+        )
+        if len(results["ids"]) > 0:
+            logger.debug(f"Embedding for content hash {content_hash} found.")
+            return results["embeddings"][0]
+        return None
+
+    def kbb_search_by_ids(
+        self, 
+        kbb_ids: List[str], 
+        include_embeddings: bool = True
+    ) -> List[dict]:
+        """
+        Search for several KBB entries by their IDs with a single call.
+
+        Args:
+            kbb_ids (List[str]): The IDs of the KBB entries to be searched.
+            include_embeddings (bool, optional): Whether to return the 
+                embeddings of the KBB entries. Defaults to True.
+
+        Returns:
+            List[dict]: The KBB entries' data, in the same order as `kbb_ids`. 
+                An empty dictionary is returned for each KBB not found.
+        """
+        if len(kbb_ids) == 0:
+            return []
+        self.flush()
+        results = self._kbb_collection.get(
+            ids=list(kbb_ids),
+            include=['embeddings', 'metadatas'] \
+                if include_embeddings else ['metadatas']
+        )
+        dict_kbb_data = {}
+        for i, (kbb_id, metadata) in enumerate(
+            zip(results["ids"], results["metadatas"])
+        ):
+            kbb_data = _decode_kbb_metadata(metadata)
+            if include_embeddings:
+                kbb_data["embedding"] = results["embeddings"][i]
+            dict_kbb_data[kbb_id] = kbb_data
+        logger.debug(f"Found {len(dict_kbb_data)} of {len(kbb_ids)} KBBs.")
+        return [dict_kbb_data.get(kbb_id, {}) for kbb_id in kbb_ids]
+
     def kbb_search_by_text(
         self, 
         text: str, 
-        kbb_ids_to_query: List[str] = [], 
+        kbb_ids_to_query: Union[List[str], set, None] = None, 
         distance: float = 1.0, 
-        n_results: int = 10
+        n_results: int = 10,
+        include_embeddings: bool = False,
+        where: Union[dict, None] = None
     ) -> list:
         """
         Search for KBB entries that match the given text.
@@ -285,47 +589,286 @@ class ChromaDBConnection(DatabaseConnection):
 
         Args:
             text (str): The input text to search for in the KBB collection.
-            kbb_ids_to_query (list, optional): A list of KBB IDs to narrow down 
-                the search. If empty, all KBB entries will be considered. 
-                Defaults to an empty list.
+            kbb_ids_to_query (list or set, optional): The KBB IDs to narrow down 
+                the search. If empty or None, all KBB entries will be 
+                considered. Defaults to None.
             distance (float, optional): The maximum distance allowable for an 
                 entry to be considered a match. Defaults to 1.0 (lower values 
                 are stricter).
             n_results (int, optional): The maximum number of results to return. 
                 Defaults to 10.
+            include_embeddings (bool, optional): Whether to return the 
+                embeddings of the matching KBB entries. Defaults to False.
+            where (dict, optional): A precomputed Chroma `where` clause, used 
+                instead of the one built from `kbb_ids_to_query`. Useful when 
+                the same filter is reused across many queries. 
+                Defaults to None.
 
         Returns:
             list: A list of tuples, each containing the distance to the matching 
                 KBB entry and the corresponding KBB entry. If no matches are 
                 found, an empty list is returned.
         """
-        query_embedding = self.embedding_function([text])
-        collection = self.client.get_collection("KBB")
-        where_clause = {} if len(kbb_ids_to_query) == 0 \
-            else {"kbb_id": {"$in": kbb_ids_to_query}}
-        results = collection.query(
+        self.flush()
+        query_embedding = [list(self._embed(text))]
+        where_clause = where if where is not None \
+            else kbb_where_clause(kbb_ids_to_query)
+        return self._query_kbbs(
             query_embeddings=query_embedding, 
+            where_clause=where_clause, 
+            distance=distance, 
+            n_results=n_results, 
+            include_embeddings=include_embeddings
+        )[0]
+
+    def kbb_search_by_text_batch(
+        self, 
+        texts: List[str], 
+        kbb_ids_to_query: Union[List[str], set, None] = None, 
+        distance: float = 1.0, 
+        n_results: int = 10,
+        include_embeddings: bool = False,
+        where: Union[dict, None] = None
+    ) -> List[list]:
+        """
+        Search for KBB entries that match each of the given texts.
+
+        This method works as `kbb_search_by_text`, but it generates the 
+        embeddings of all the texts and queries the KBB collection with a 
+        single call each.
+
+        Args:
+            texts (List[str]): The input texts to search for in the KBB 
+                collection.
+            kbb_ids_to_query (list or set, optional): The KBB IDs to narrow down 
+                the search. If empty or None, all KBB entries will be 
+                considered. Defaults to None.
+            distance (float, optional): The maximum distance allowable for an 
+                entry to be considered a match. Defaults to 1.0 (lower values 
+                are stricter).
+            n_results (int, optional): The maximum number of results to return 
+                for each text. Defaults to 10.
+            include_embeddings (bool, optional): Whether to return the 
+                embeddings of the matching KBB entries. Defaults to False.
+            where (dict, optional): A precomputed Chroma `where` clause, used 
+                instead of the one built from `kbb_ids_to_query`. Useful when 
+                the same filter is reused across many queries. 
+                Defaults to None.
+
+        Returns:
+            List[list]: For each input text, a list of tuples as returned by 
+                `kbb_search_by_text`.
+        """
+        if len(texts) == 0:
+            return []
+        self.flush()
+        query_embeddings = self.embedding_function(texts)
+        where_clause = where if where is not None \
+            else kbb_where_clause(kbb_ids_to_query)
+        return self._query_kbbs(
+            query_embeddings=query_embeddings, 
+            where_clause=where_clause, 
+            distance=distance, 
             n_results=n_results, 
-            include=["documents", "metadatas", "distances", "embeddings"], 
+            include_embeddings=include_embeddings
+        )
+
+    def _query_kbbs(
+        self, 
+        query_embeddings: List[Any], 
+        where_clause: Union[dict, None], 
+        distance: float, 
+        n_results: int, 
+        include_embeddings: bool
+    ) -> List[list]:
+        """
+        Query the KBB collection and decode the close enough KBBs.
+
+        For large values of `n_results`, the collection is first queried for 
+        the distances only, and the data are then fetched just for the KBBs 
+        within the distance threshold, so that the rejected KBBs are neither 
+        transferred nor decoded.
+
+        Args:
+            query_embeddings (List[Any]): The embeddings to query with.
+            where_clause (dict or None): The metadata filter of the query.
+            distance (float): The maximum distance allowable for an entry to 
+                be considered a match.
+            n_results (int): The maximum number of results for each query 
+                embedding.
+            include_embeddings (bool): Whether to return the embeddings of the 
+                matching KBB entries.
+
+        Returns:
+            List[list]: For each query embedding, a list of tuples, each 
+                containing the distance to the matching KBB entry and the 
+                corresponding KBB entry, sorted by distance.
+        """
+        if n_results < TWO_PASS_QUERY_MIN_RESULTS:
+            results = self._kbb_collection.query(
+                query_embeddings=query_embeddings, 
+                n_results=n_results, 
+                include=_query_include(include_embeddings), 
+                where=where_clause
+            )
+            return [
+                _filter_query_results(results, i, distance) 
+                for i in range(len(query_embeddings))
+            ]
+        results = self._kbb_collection.query(
+            query_embeddings=query_embeddings, 
+            n_results=n_results, 
+            include=["distances"], 
             where=where_clause
         )
-        list_kbb_data = []
-        list_distances = []
-        for _ in range(len(results["ids"][0])):
-            if results["distances"][0][_] <= distance:
-                kbb_data = results["metadatas"][0][_].copy()
-                kbb_data["embeddings"] = results["embeddings"][0][_]
-                kbb_data["parents_kbb"] = literal_eval(kbb_data["parents_kbb"])
-                kbb_data["tms_create"] = float(kbb_data["tms_create"])
-                kbb_data["tms_compute"] = float(kbb_data["tms_compute"])
-                list_kbb_data.append(kbb_data)
-                list_distances.append(results["distances"][0][_])
-        if len(list_kbb_data) > 0:
-            tmp = sorted(zip(list_distances, range(len(list_distances)), list_kbb_data))
-            list_output = [(d, kbb_data) for d, _, kbb_data in tmp]
-            logger.debug(f"Found {len(list_output)} KBBs.")
-            return list_output
-        else:
+        list_kept = [
+            [
+                (kbb_id, d) for kbb_id, d in zip(ids, distances) 
+                if d <= distance
+            ]
+            for ids, distances in zip(results["ids"], results["distances"])
+        ]
+        kept_ids = list({kbb_id: None for kept in list_kept for kbb_id, _ in kept})
+        if len(kept_ids) == 0:
             logger.debug(f"Found 0 KBB.")
-            return []
+            return [[] for _ in list_kept]
+        include = _query_include(include_embeddings)
+        include.remove("distances")
+        rows = self._kbb_collection.get(ids=kept_ids, include=include)
+        positions = {kbb_id: j for j, kbb_id in enumerate(rows["ids"])}
+        results = {
+            "distances": [[d for _, d in kept] for kept in list_kept],
+            "metadatas": [
+                [dict(rows["metadatas"][positions[kbb_id]]) for kbb_id, _ in kept] 
+                for kept in list_kept
+            ],
+            "embeddings": [
+                [rows["embeddings"][positions[kbb_id]] for kbb_id, _ in kept] 
+                for kept in list_kept
+            ] if include_embeddings else None,
+        }
+        return [
+            _filter_query_results(results, i, distance) 
+            for i in range(len(list_kept))
+        ]
+
+    def _embed_text(self, text: str) -> tuple:
+        """
+        Generate the embedding of a text with the embedding function.
+
+        The instance wraps this method in an LRU cache (`self._embed`), so 
+        that repeated queries do not call the embedding API again.
+
+        Args:
+            text (str): The input text.
+
+        Returns:
+            tuple: The embedding of the text.
+        """
+        return tuple(self.embedding_function([text])[0])
+
+    '''OP'''
 
+    def op_result_create(self, op_key: str, result: dict):
+        """
+        Store the result of a KBB operation.
+
+        Args:
+            op_key (str): The key of the operation, see `op_result_key`.
+            result (dict): The result of the operation, with its 
+                "raw_output" and "parsed_output".
+        """
+        self._op_collection.upsert(
+            ids=[op_key], 
+            embeddings=[[0]],
+            metadatas=[{"result": orjson.dumps(result).decode()}]
+        )
+        logger.debug(f"OP {op_key} stored.")
+
+    def op_result_search_by_id(self, op_key: str) -> Union[dict, None]:
+        """
+        Search for the result of a KBB operation by its key.
+
+        Args:
+            op_key (str): The key of the operation, see `op_result_key`.
+
+        Returns:
+            dict or None: The result of the operation if found, 
+                otherwise None.
+        """
+        results = self._op_collection.get(
+            ids=[op_key],
+            include=['metadatas']
+        )
+        if len(results["ids"]) > 0:
+            logger.debug(f"OP {op_key} found.")
+            return orjson.loads(results["metadatas"][0]["result"])
+        return None
+
+
+class ChromaDBConnectionAsync:
+    """
+    ChromaDBConnectionAsync class to bulk load KBBs into a Chroma database.
+
+    This class relies on the asynchronous Chroma client to add large amounts 
+    of KBBs with several concurrent requests. The regular operations on KBD, 
+    KBN and KBB remain available through ChromaDBConnection.
+    """
+
+    def __init__(self, batch_size: int = 128):
+        """
+        Initialize the ChromaDBConnectionAsync instance.
+
+        The asynchronous client is created on first use, since it has to be 
+        awaited.
+
+        Args:
+            batch_size (int, optional): The number of KBBs sent with each 
+                request. Defaults to 128.
+        """
+        self.batch_size = batch_size
+        self.client = None
+        self._kbb_collection = None
+
+    async def _get_kbb_collection(self):
+        """
+        Return the KBB collection, connecting to the database if needed.
+        """
+        if self._kbb_collection is None:
+            self.client = await AsyncHttpClient(
+                host=os.getenv('CHROMA_DB_HOST'), 
+                port=os.getenv('CHROMA_DB_PORT')
+            )
+            self._kbb_collection = \
+                await self.client.get_or_create_collection("KBB")
+            logger.debug("ChromaDB async client ready.")
+        return self._kbb_collection
+
+    async def kbb_create_many_async(
+        self, 
+        kbbs: List[Any], 
+        concurrency: int = 4
+    ):
+        """
+        Add several KBB entries to the KBB collection with concurrent requests.
+
+        The KBBs are split into batches of `batch_size` entries, and at most 
+        `concurrency` batches are sent at the same time.
+
+        Args:
+            kbbs (List[KBB]): The KBB objects containing the data to be added.
+            concurrency (int, optional): The maximum number of concurrent 
+                requests. Defaults to 4.
+        """
+        collection = await self._get_kbb_collection()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def add_batch(batch: List[Any]):
+            async with semaphore:
+                await collection.add(**_kbb_records(batch))
+
+        await asyncio.gather(*[
+            add_batch(kbbs[i:i + self.batch_size]) 
+            for i in range(0, len(kbbs), self.batch_size)
+        ])
+        logger.debug(f"{len(kbbs)} KBBs added.")
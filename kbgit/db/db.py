@@ -5,18 +5,6 @@ class DatabaseConnection(ABC):
 
     '''KBD'''
 
-    @abstractmethod
-    def kbd_exists_collection(self):
-        pass
-
-    @abstractmethod
-    def kbd_create_collection(self):
-        pass
-
-    def kbd_create_collection_if_not_exists(self):
-        if not self.kbd_exists_collection():
-            self.kbd_create_collection()
-
     def kbd_exists(self, kbd_id):
         return len(self.kbd_search_by_id(kbd_id=kbd_id)) > 0
 
@@ -30,18 +18,6 @@ class DatabaseConnection(ABC):
 
     '''KBN'''
 
-    @abstractmethod
-    def kbn_exists_collection(self):
-        pass
-
-    @abstractmethod
-    def kbn_create_collection(self):
-        pass
-
-    def kbn_create_collection_if_not_exists(self):
-        if not self.kbn_exists_collection():
-            self.kbn_create_collection()
-
     def kbn_exists(self, kbn_id):
         return len(self.kbn_search_by_id(kbn_id=kbn_id)) > 0
 
@@ -63,35 +39,59 @@ class DatabaseConnection(ABC):
 
     ''' KBB '''
 
+    def kbb_exists(self, kbb_id):
+        return len(self.kbb_search_by_id(kbb_id=kbb_id)) > 0
+
     @abstractmethod
-    def kbb_exists_collection(self):
+    def kbb_create(self, kbb):
         pass
 
     @abstractmethod
-    def kbb_create_collection(self):
+    def kbb_create_many(self, kbbs):
         pass
 
-    def kbb_create_collection_if_not_exists(self):
-        if not self.kbb_exists_collection():
-            self.kbb_create_collection()
-
-    def kbb_exists(self, kbb_id):
-        return len(self.kbb_search_by_id(kbb_id=kbb_id)) > 0
+    @abstractmethod
+    def kbb_search_by_id(self, kbb_id):
+        pass
 
     @abstractmethod
-    def kbb_create(self, kbb):
+    def kbb_search_by_ids(self, kbb_ids, include_embeddings=True):
         pass
 
     @abstractmethod
-    def kbb_search_by_id(self, kbb_id):
+    def kbb_embedding_by_hash(self, content_hash):
         pass
 
     @abstractmethod
     def kbb_search_by_text(
         self, 
         text, 
-        kbb_ids_to_query=[], 
+        kbb_ids_to_query=None, 
         distance=1.0, 
-        n_results=3
+        n_results=3,
+        include_embeddings=False,
+        where=None
     ):
         pass
+
+    @abstractmethod
+    def kbb_search_by_text_batch(
+        self, 
+        texts, 
+        kbb_ids_to_query=None, 
+        distance=1.0, 
+        n_results=3,
+        include_embeddings=False,
+        where=None
+    ):
+        pass
+
+    ''' OP '''
+
+    @abstractmethod
+    def op_result_create(self, op_key, result):
+        pass
+
+    @abstractmethod
+    def op_result_search_by_id(self, op_key):
+        pass
@@ -1,8 +1,41 @@
 import os
-from .chroma import ChromaDBConnection
+from importlib import import_module
+from threading import Lock
+from ..log import logger
+
+
+# Available backends, by DB_TYPE. Each backend is imported only when it is
+# first requested.
+# TODO. Add more DB connections here
+_BACKENDS = {
+    "chroma": "kbgit.db.chroma:ChromaDBConnection",
+}
+
+# Connections are shared by the whole process, so that the underlying HTTP
+# sessions (and their keep-alive connections) are reused across calls. They
+# are keyed by backend, host and port (read from the <DB_TYPE>_DB_HOST and
+# <DB_TYPE>_DB_PORT environment variables, e.g. CHROMA_DB_HOST).
+_db_connections: dict = {}
+_db_connections_lock = Lock()
 
 
 def get_db_connection():
-    # TODO. Add more DB connections here
-    if os.getenv('DB_TYPE') == "chroma":
-        return ChromaDBConnection()
\ No newline at end of file
+    db_type = os.getenv('DB_TYPE')
+    if db_type not in _BACKENDS:
+        logger.warning(f"Unknown DB_TYPE {db_type}. No DB connection.")
+        return None
+    prefix = db_type.upper()
+    key = (
+        db_type,
+        os.getenv(f'{prefix}_DB_HOST'),
+        os.getenv(f'{prefix}_DB_PORT')
+    )
+    db_connection = _db_connections.get(key)
+    if db_connection is not None:
+        return db_connection
+    with _db_connections_lock:
+        if key not in _db_connections:
+            module_name, class_name = _BACKENDS[db_type].split(":")
+            db_class = getattr(import_module(module_name), class_name)
+            _db_connections[key] = db_class()
+        return _db_connections[key]
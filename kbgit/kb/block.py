@@ -1,14 +1,16 @@
-import os
+import sys
 from uuid import uuid4
 from time import time
 from datetime import datetime, timezone
-from itertools import groupby
-from igraph import Graph # type: ignore
-from typing import Dict, List, Union, Any, Self
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from typing import Dict, Iterator, List, Union, Any, Self
 from ..db.tools import get_db_connection
-from ..llm import get_embedding, llm_text_rewrite, llm_text_remove, llm_conflicts_detect, llm_correct
+from ..config import compute_parallelism, embedding_output_size
 from ..log import logger
 
+
 class KBB:
     """
     KBB class represents a knowledge block in a knowledge base.
@@ -53,6 +55,7 @@ class KBB:
         """
 
         self.data = {}
+        self._compute_lock = Lock()
         
         if kbb_id is not None:
             self._pull_from_db(kbb_id=kbb_id)
@@ -63,17 +66,21 @@ class KBB:
         else:
             raise Exception("KBB initialization failed. No data provided")
         
+        # IDs are interned, so that the many references to the same KBB (in 
+        # the KBDs, their operations and the parents of other KBBs) share 
+        # a single string.
         if "kbb_id" not in self.data.keys():
-            self.data["kbb_id"] = f"kbb_{uuid4()}"
+            self.data["kbb_id"] = sys.intern(f"kbb_{uuid4().hex}")
+        else:
+            self.data["kbb_id"] = sys.intern(self.data["kbb_id"])
         if "kbn_id" not in self.data.keys():
-            self.data["kbn_id"] = f"kbn_{uuid4()}"
+            self.data["kbn_id"] = sys.intern(f"kbn_{uuid4().hex}")
+        else:
+            self.data["kbn_id"] = sys.intern(self.data["kbn_id"])
         if "embedding" not in self.data.keys():
-            EMBEDDING_OUTPUT_SIZE = os.getenv("EMBEDDING_OUTPUT_SIZE")
-            if (EMBEDDING_OUTPUT_SIZE is None) or (EMBEDDING_OUTPUT_SIZE == ""):
-                emb_output_size = 1
-            else:
-                emb_output_size = int(EMBEDDING_OUTPUT_SIZE)
-            self.data["embedding"] = [0] * emb_output_size
+            self.data["embedding"] = np.zeros(
+                embedding_output_size(), dtype=np.float32
+            )
         if "content" not in self.data.keys():
             self.data["content"] = ""
         if "parents_op" not in self.data.keys():
@@ -85,7 +92,11 @@ class KBB:
         if "tms_create" not in self.data.keys():
             self.data["tms_create"] = time()
 
-        self.data["content"] = str(self.data["content"])
+        if not isinstance(self.data["content"], str):
+            self.data["content"] = str(self.data["content"])
+        for key in ("tms_create", "tms_compute"):
+            if key in self.data and not isinstance(self.data[key], float):
+                self.data[key] = float(self.data[key])
 
 
     def __str__(self) -> str:
@@ -93,27 +104,45 @@ class KBB:
         Return a string representation of the KBB.
 
         This method generates a formatted string that displays the KBB's 
-        content, IDs, and timestamps. If the KBB's state is not 'computed', 
-        it computes the KBB before returning the string representation.
+        content, IDs, and timestamps. It never computes the KBB: an 
+        uncomputed KBB is shown with its operation, ID and creation time only. 
+        Use `render` to compute the KBB before printing it.
 
         Returns:
             str: A formatted string containing details about the KBB.
         """
+        tms_create = datetime.fromtimestamp(self.data["tms_create"])
         if self.data["state"] != "computed":
-            self.compute(
-                msg=f"Computed on {str(datetime.now(timezone.utc))} " + \
-                    "to print the content."
-            )
+            return \
+                f'[{self.data["parents_op"]}] [uncomputed] ' + \
+                f'[{self.data["kbb_id"]}] ' + \
+                f'[{tms_create.strftime("%Y-%m-%d %H:%M:%S")}] '
+        tms_compute = datetime.fromtimestamp(self.data["tms_compute"])
         output_string = \
             f'[{self.data["parents_op"]}] ' + \
             f'{self.data["content"]} ' + \
             f'[{self.data["kbb_id"]}] ' + \
             f'[{self.data["kbn_id"]}] ' + \
-            f'[{datetime.fromtimestamp(float(self.data["tms_create"])).strftime("%Y-%m-%d %H:%M:%S")}] ' + \
-            f'[{datetime.fromtimestamp(float(self.data["tms_compute"])).strftime("%Y-%m-%d %H:%M:%S")}] '
+            f'[{tms_create.strftime("%Y-%m-%d %H:%M:%S")}] ' + \
+            f'[{tms_compute.strftime("%Y-%m-%d %H:%M:%S")}] '
         return output_string
 
 
+    def render(self) -> str:
+        """
+        Compute the KBB if needed and return its string representation.
+
+        Returns:
+            str: A formatted string containing details about the KBB.
+        """
+        if self.data["state"] != "computed":
+            self.compute(
+                msg=f"Computed on {str(datetime.now(timezone.utc))} " + \
+                    "to print the content."
+            )
+        return self.__str__()
+
+
     def _pull_from_db(self, kbb_id: str):
         """
         Retrieve KBB data from the database.
@@ -127,6 +156,9 @@ class KBB:
         db_connection = get_db_connection()
         kbb_data = db_connection.kbb_search_by_id(kbb_id)
         if len(kbb_data) > 0:
+            kbb_data["embedding"] = np.asarray(
+                kbb_data["embedding"], dtype=np.float32
+            )
             self.data = kbb_data
 
     
@@ -200,32 +232,47 @@ class KBB:
         Returns:
             KBB: A new KBB instance that combines the KBBs of both instances.
         """
+        return KBB.sum_many([self, kbb])
+
+
+    @classmethod
+    def sum_many(cls, kbbs: List["KBB"]) -> "KBB":
+        """
+        Combine several KBB entries into a single new KBB entry.
+
+        This is equivalent to `sum(kbbs)`, but the parents are collected in a 
+        single pass instead of building an intermediate KBB for each 
+        addition. Uncomputed sums are flattened into their parents.
+
+        Args:
+            kbbs (List[KBB]): The KBB instances to add.
+
+        Returns:
+            KBB: A new KBB instance that combines the given KBBs, or the KBB 
+                itself if only one is given.
+
+        Raises:
+            Exception: If no KBB is given.
+        """
+        kbbs = list(kbbs)
+        if len(kbbs) == 0:
+            raise Exception("KBB sum failed. No KBB provided.")
+        if len(kbbs) == 1:
+            return kbbs[0]
         list_parents_kbb: List[Any] = []
-        if (self.data["state"] == "computed"):
-            list_parents_kbb.append(
-                {
-                    "kbn_id": self.data["kbn_id"], 
-                    "kbb_id": self.data["kbb_id"]
-                }
-            )
-        else:
-            if self.data["parents_op"] == "sum":
-                list_parents_kbb = list_parents_kbb + self.data["parents_kbb"]
-            else: 
-                list_parents_kbb.append(self)
-        if (kbb.data["state"] == "computed"):
-            list_parents_kbb.append(
-                {
-                    "kbn_id": kbb.data["kbn_id"], 
-                    "kbb_id": kbb.data["kbb_id"]
-                }
-            )
-        else:
-            if kbb.data["parents_op"] == "sum":
-                list_parents_kbb = list_parents_kbb + kbb.data["parents_kbb"]
+        for kbb in kbbs:
+            if (kbb.data["state"] == "computed"):
+                list_parents_kbb.append(
+                    {
+                        "kbn_id": kbb.data["kbn_id"], 
+                        "kbb_id": kbb.data["kbb_id"]
+                    }
+                )
+            elif kbb.data["parents_op"] == "sum":
+                list_parents_kbb.extend(kbb.data["parents_kbb"])
             else: 
                 list_parents_kbb.append(kbb)
-        return KBB(
+        return cls(
             kbb_data={
                 "parents_op": "sum",
                 "parents_kbb": list_parents_kbb
@@ -243,7 +290,8 @@ class KBB:
 
     def compute(
         self, 
-        msg: str = f"Computed on {str(datetime.now(timezone.utc))}.", 
+        msg: Union[str, None] = None, 
+        embedding: Union[np.ndarray, None] = None
     ):
         """
         Compute and finalize the state of the KBB.
@@ -255,9 +303,13 @@ class KBB:
         to the database.
 
         Args:
-            msg (str, optional): An optional message to attach to the 
-                computation log. Defaults to a timestamp indicating when the 
-                computation was completed.
+            msg (Union[str, None], optional): An optional message to attach 
+                to the computation log. Defaults to None, in which case a 
+                message with the current timestamp is used.
+            embedding (Union[np.ndarray, None], optional): The embedding of 
+                the content of the KBB, if already known (e.g. prefetched by 
+                the KBD). Ignored for the "sum" and "sub" operations, whose 
+                content is generated. Defaults to None.
 
         Raises:
             AssertionError: If the KBB's state is not 'uncomputed' when this 
@@ -280,6 +332,16 @@ class KBB:
         assert (self.data["state"] == "uncomputed"), \
             "You can compute only uncomputed KBB."
 
+        # The LLM clients are imported only when a KBB is actually computed.
+        from ..llm import (
+            content_hash, 
+            get_embedding_cached, 
+            llm_op_cached, 
+            llm_text_rewrite, 
+            llm_text_remove
+        )
+        db_connection = get_db_connection()
+
         if self.data["parents_op"] in ["creation"]: 
             self.data["parents_kbb"] = []
 
@@ -291,16 +353,9 @@ class KBB:
             assert len(self.data["parents_kbb"]) == 2, \
                 "The operation sub requires two parents."
             list_parents_contents = []
+            list_to_rewrite = []
             new_parents_kbb = []
-            for parent_kbb in self.data["parents_kbb"]:
-                if type(parent_kbb) == dict: # already computed
-                    parent_kbb = KBB(kbb_id=parent_kbb["kbb_id"])
-                else:
-                    parent_kbb.compute(
-                        msg=f"Computed on {str(datetime.now(timezone.utc))} "+\
-                            f'because parent of {self.data["kbb_id"]}, '+\
-                            f"operation sub."
-                    )
+            for parent_kbb in self._compute_parents():
                 new_parents_kbb.append(
                     {
                         "kbn_id": parent_kbb.data["kbn_id"], 
@@ -308,14 +363,18 @@ class KBB:
                     }
                 )
                 if parent_kbb.data["parents_op"] in ["creation", "edit"]:
-                    list_parents_contents.append(
-                        llm_text_rewrite(text=parent_kbb.data["content"])["parsed_output"]
-                    )
-                else:
-                    list_parents_contents.append(parent_kbb.data["content"])
-            dict_content = llm_text_remove(
-                text1=list_parents_contents[0],
-                text2=list_parents_contents[1]
+                    list_to_rewrite.append(len(list_parents_contents))
+                list_parents_contents.append(parent_kbb.data["content"])
+            _rewrite_contents(list_parents_contents, list_to_rewrite)
+            dict_content = llm_op_cached(
+                operation="sub", 
+                contents=list_parents_contents, 
+                call=lambda: llm_text_remove(
+                    text1=list_parents_contents[0],
+                    text2=list_parents_contents[1]
+                ), 
+                lookup=db_connection.op_result_search_by_id, 
+                store=db_connection.op_result_create
             )
             self.data["parents_kbb"] = new_parents_kbb
             self.data["content"] = dict_content["parsed_output"]
@@ -325,17 +384,10 @@ class KBB:
             assert len(self.data["parents_kbb"]) >= 2, \
                 "The operation sum requires more than one parent."
             list_parents_contents = []
+            list_to_rewrite = []
             list_parents_tms_compute = []
             new_parents_kbb = []
-            for parent_kbb in self.data["parents_kbb"]:
-                if type(parent_kbb) == dict: # already computed
-                    parent_kbb = KBB(kbb_id=parent_kbb["kbb_id"])
-                else:
-                    parent_kbb.compute(
-                        msg=f"Computed on {str(datetime.now(timezone.utc))} "+\
-                            f"because parent of {self.data['kbb_id']}, "+\
-                            f"operation sum."
-                    )
+            for parent_kbb in self._compute_parents():
                 new_parents_kbb.append(
                     {
                         "kbn_id": parent_kbb.data["kbn_id"], 
@@ -343,23 +395,36 @@ class KBB:
                     }
                 )
                 if parent_kbb.data["parents_op"] in ["creation", "edit"]:
-                    list_parents_contents.append(
-                        llm_text_rewrite(text=parent_kbb.data["content"])["parsed_output"]
-                    )
-                else:
-                    list_parents_contents.append(parent_kbb.data["content"])
-                list_parents_tms_compute.append(float(parent_kbb.data["tms_compute"]))
+                    list_to_rewrite.append(len(list_parents_contents))
+                list_parents_contents.append(parent_kbb.data["content"])
+                list_parents_tms_compute.append(parent_kbb.data["tms_compute"])
+            _rewrite_contents(list_parents_contents, list_to_rewrite)
             list_parents_contents_ordered = [item for _, item in sorted(zip(list_parents_tms_compute, list_parents_contents))]
-            dict_content = llm_text_rewrite(text=" \n".join(list_parents_contents_ordered))
+            dict_content = llm_op_cached(
+                operation="sum", 
+                contents=list_parents_contents_ordered, 
+                call=lambda: llm_text_rewrite(
+                    text=" \n".join(list_parents_contents_ordered)
+                ), 
+                lookup=db_connection.op_result_search_by_id, 
+                store=db_connection.op_result_create
+            )
             self.data["parents_kbb"] = new_parents_kbb
             self.data["content"] = dict_content["parsed_output"]
             self.data["content_raw"] = dict_content["raw_output"]
 
-        self.data["embedding"] = get_embedding(self.data["content"])
+        self.data["content_hash"] = content_hash(self.data["content"])
+        if (embedding is None) or (self.data["parents_op"] in ["sum", "sub"]):
+            embedding = get_embedding_cached(
+                self.data["content"], 
+                lookup=db_connection.kbb_embedding_by_hash
+            )
+        self.data["embedding"] = embedding
+        if msg is None:
+            msg = f"Computed on {str(datetime.now(timezone.utc))}."
         self.data["compute_msg"] = msg
         self.data["tms_compute"] = time()
         self.data["state"] = "computed"
-        db_connection = get_db_connection()
         db_connection.kbb_create(self)
 
         if self.data["parents_op"] in ["create", "sum", "sub"]: 
@@ -377,6 +442,58 @@ class KBB:
             )
 
 
+    def _compute_parents(self) -> List["KBB"]:
+        """
+        Return the parent KBBs, computing the uncomputed ones concurrently.
+
+        Parents that are already computed are pulled from the database, while 
+        the uncomputed ones are computed in a thread pool, since their 
+        computations are independent and mostly wait for the LLM and the 
+        database.
+
+        Returns:
+            List[KBB]: The computed parent KBBs, in the same order as 
+                `parents_kbb`.
+        """
+        list_parents = []
+        dict_uncomputed = {}
+        for parent_kbb in self.data["parents_kbb"]:
+            if isinstance(parent_kbb, dict): # already computed
+                parent_kbb = KBB(kbb_id=parent_kbb["kbb_id"])
+            else:
+                dict_uncomputed[id(parent_kbb)] = parent_kbb
+            list_parents.append(parent_kbb)
+        msg = f"Computed on {str(datetime.now(timezone.utc))} " + \
+            f"because parent of {self.data['kbb_id']}, " + \
+            f"operation {self.data['parents_op']}."
+        compute_many(list(dict_uncomputed.values()), msg=msg)
+        return list_parents
+
+
+    def ensure_computed(
+        self, 
+        msg: Union[str, None] = None, 
+        embedding: Union[np.ndarray, None] = None
+    ):
+        """
+        Compute the KBB, unless it is already computed.
+
+        Unlike `compute`, this method can be called concurrently on the same 
+        KBB (e.g. a parent shared by several KBBs computed in parallel): the 
+        KBB is computed only once.
+
+        Args:
+            msg (Union[str, None], optional): An optional message to attach 
+                to the computation log. Defaults to None.
+            embedding (Union[np.ndarray, None], optional): The embedding of 
+                the content of the KBB, if already known, see `compute`. 
+                Defaults to None.
+        """
+        with self._compute_lock:
+            if self.data["state"] != "computed":
+                self.compute(msg=msg, embedding=embedding)
+
+
     def show_node_history(self):
         """
         Display the history of KBB nodes associated with this KBB.
@@ -393,8 +510,12 @@ class KBB:
             )
         db_connection = get_db_connection()
         list_node_kbbs = db_connection.kbn_search_by_id(self.data["kbn_id"])
+        dict_kbbs = _pull_kbbs_from_db(
+            list(list_node_kbbs.keys()), 
+            include_embeddings=False
+        )
         list_node_history = [
-            KBB(kbb_id=kbb_id).__str__() for kbb_id in list_node_kbbs.keys()
+            dict_kbbs[kbb_id].render() for kbb_id in list_node_kbbs.keys()
         ]
         self.list_node_history = list_node_history
         print("\n".join(self.list_node_history))
@@ -412,26 +533,44 @@ class KBB:
         assert self.data["state"] == "computed", \
             "To show the history of the KBB, you need to compute it."
 
-        list_kbb_ids = [self.data["kbb_id"]]
-        list_sentences = [self.__str__()]
-        list_ids = [{"parent": self.data["kbb_id"], "child": c["kbb_id"]} for c in self.data["parents_kbb"]]
-
+        # The ancestors are pulled wave by wave, each of them only once, and 
+        # the tree is then serialized with a single depth-first traversal. 
+        dict_kbbs = {self.data["kbb_id"]: self}
+        dict_children = {}
+        list_ids = [self.data["kbb_id"]]
         while len(list_ids) > 0:
-            pc = list_ids.pop(0)
-            kbb = KBB(kbb_id=pc["child"])
-
-            tmp_list_parents_pos = [index for index, value in enumerate(list_kbb_ids) if value == pc["parent"]]
-            sentence = f'↑__ {kbb.__str__()}'
-
-            for j, p in enumerate(tmp_list_parents_pos):
-                list_kbb_ids.insert(p+j+1, pc["child"])
-                n_white_spaces = len(list_sentences[p+j]) - len(list_sentences[p+j].lstrip())
-                list_sentences.insert(p+j+1, " " * (n_white_spaces+5) + sentence)
+            list_new_ids = []
+            for kbb_id in list_ids:
+                list_children = list(dict.fromkeys(
+                    c["kbb_id"] for c in dict_kbbs[kbb_id].data["parents_kbb"]
+                ))
+                dict_children[kbb_id] = list_children
+                list_new_ids.extend(
+                    c for c in list_children if c not in dict_kbbs
+                )
+            list_ids = list(dict.fromkeys(list_new_ids))
+            dict_kbbs.update(
+                _pull_kbbs_from_db(list_ids, include_embeddings=False)
+            )
 
-            new_children = kbb.data["parents_kbb"]
-            list_ids.extend([{"parent": pc["child"], "child": c["kbb_id"]} for c in new_children])
+        dict_sentences = {}
+        list_sentences = []
+        list_stack = [(self.data["kbb_id"], 0)]
+        while len(list_stack) > 0:
+            kbb_id, n_white_spaces = list_stack.pop()
+            if kbb_id not in dict_sentences:
+                dict_sentences[kbb_id] = dict_kbbs[kbb_id].render()
+            if n_white_spaces == 0:
+                list_sentences.append(dict_sentences[kbb_id])
+            else:
+                list_sentences.append(
+                    " " * n_white_spaces + f'↑__ {dict_sentences[kbb_id]}'
+                )
+            list_stack.extend(
+                (c, n_white_spaces + 5) for c in dict_children[kbb_id]
+            )
 
-        self.list_kbb_history = [key for key, group in groupby(list_sentences)]
+        self.list_kbb_history = list_sentences
         self.list_kbb_history = fixed_length_list(
             list_strings=self.list_kbb_history, 
             l=100, 
@@ -455,30 +594,36 @@ class KBB:
         """
         assert self.data["state"] == "computed", \
             "To build the history graph of the KBB, you need to compute it."
+        from igraph import Graph # type: ignore
         list_nodes = [self.data["kbb_id"]]
         self.g = Graph(directed=True)
         self.g.add_vertex(
             name=self.data["kbb_id"], 
             node=self.data["kbn_id"],    
         )
+        set_visited = set()
         while len(list_nodes) > 0:
-            kbb_id = list_nodes.pop(0)
-            kbb = KBB(kbb_id=kbb_id)
-            vertex_index = self.g.vs.select(name=kbb.data["kbb_id"])[0].index
-            self.g.vs[vertex_index]["content"] = kbb.data["content"] 
-            kbb_parents = kbb.data["parents_kbb"]
-            for kbb_parent in kbb_parents:
-                list_nodes.append(kbb_parent["kbb_id"])
-                if len(self.g.vs.select(name=kbb_parent["kbb_id"])) == 0:
-                    self.g.add_vertex(
-                        name=kbb_parent["kbb_id"], 
-                        node=kbb_parent["kbn_id"],
-                    )
-                if self.g.get_eid(kbb_parent["kbb_id"], kbb.data["kbb_id"], directed=True, error=False) == -1:
-                    self.g.add_edge(
-                        source=kbb_parent["kbb_id"], 
-                        target=kbb.data["kbb_id"]
-                    )
+            list_wave = [_ for _ in dict.fromkeys(list_nodes) if _ not in set_visited]
+            list_nodes = []
+            set_visited.update(list_wave)
+            dict_kbbs = _pull_kbbs_from_db(list_wave, include_embeddings=False)
+            for kbb_id in list_wave:
+                kbb = dict_kbbs[kbb_id]
+                vertex_index = self.g.vs.select(name=kbb.data["kbb_id"])[0].index
+                self.g.vs[vertex_index]["content"] = kbb.data["content"] 
+                kbb_parents = kbb.data["parents_kbb"]
+                for kbb_parent in kbb_parents:
+                    list_nodes.append(kbb_parent["kbb_id"])
+                    if len(self.g.vs.select(name=kbb_parent["kbb_id"])) == 0:
+                        self.g.add_vertex(
+                            name=kbb_parent["kbb_id"], 
+                            node=kbb_parent["kbn_id"],
+                        )
+                    if self.g.get_eid(kbb_parent["kbb_id"], kbb.data["kbb_id"], directed=True, error=False) == -1:
+                        self.g.add_edge(
+                            source=kbb_parent["kbb_id"], 
+                            target=kbb.data["kbb_id"]
+                        )
 
     
     def recompute(self) -> "KBB":
@@ -495,21 +640,46 @@ class KBB:
         """
         assert self.data["state"] == "computed", \
             "To recompute the KBB, you need to compute it first."
+        dict_kbbs = {}
         list_kbb_ids = [self.data["kbb_id"]]
+        while len(list_kbb_ids) > 0:
+            dict_wave = _pull_kbbs_from_db(list_kbb_ids)
+            dict_kbbs.update(dict_wave)
+            list_kbb_ids = list(dict.fromkeys(
+                kbb_parent["kbb_id"] 
+                for kbb in dict_wave.values() 
+                for kbb_parent in kbb.data["parents_kbb"] 
+                if kbb_parent["kbb_id"] not in dict_kbbs
+            ))
+
+        # Iterative post-order traversal: every KBB comes after its parents 
+        # and is recomputed only once, even if it is reached by several paths.
         list_kbbs = []
+        set_visited = {self.data["kbb_id"]}
+        list_stack = [(
+            self.data["kbb_id"], 
+            iter(dict_kbbs[self.data["kbb_id"]].data["parents_kbb"])
+        )]
+        while len(list_stack) > 0:
+            kbb_id, iter_parents = list_stack[-1]
+            for kbb_parent in iter_parents:
+                if kbb_parent["kbb_id"] not in set_visited:
+                    set_visited.add(kbb_parent["kbb_id"])
+                    list_stack.append((
+                        kbb_parent["kbb_id"], 
+                        iter(dict_kbbs[kbb_parent["kbb_id"]].data["parents_kbb"])
+                    ))
+                    break
+            else:
+                list_stack.pop()
+                list_kbbs.append(dict_kbbs[kbb_id])
+
         dict_substitutions = {}
-        while len(list_kbb_ids) > 0:
-            kbb_id = list_kbb_ids.pop(0)
-            kbb = KBB(kbb_id=kbb_id)
-            list_kbbs.append(kbb)
-            kbb_parents = kbb.data["parents_kbb"]
-            for kbb_parent in kbb_parents:
-                list_kbb_ids.append(kbb_parent["kbb_id"])
-        list_kbbs.reverse()
         db_connection = get_db_connection()
-        while len(list_kbbs) > 0:
-            new_kbb = kbb = list_kbbs.pop(0)
-            if len(kbb.data["parents_kbb"]) == 0:
+        for kbb in list_kbbs:
+            new_kbb = kbb
+            list_parents_kbb = kbb.data["parents_kbb"]
+            if len(list_parents_kbb) == 0:
                 last_kbb_id = db_connection.kbn_get_last_kbb_id(kbn_id=kbb.data["kbn_id"])
                 if kbb.data["kbb_id"] != last_kbb_id:
                     dict_substitutions[kbb.data["kbb_id"]] = last_kbb_id
@@ -517,8 +687,8 @@ class KBB:
             else:
                 new_parents_kbb = []
                 bool_update_parent = False
-                for parent_kbb in kbb.data["parents_kbb"]:
-                    if parent_kbb["kbb_id"] in dict_substitutions.keys():
+                for parent_kbb in list_parents_kbb:
+                    if parent_kbb["kbb_id"] in dict_substitutions:
                         bool_update_parent = True
                         new_parents_kbb.append(
                             {
@@ -541,6 +711,99 @@ class KBB:
         return new_kbb
                 
 
+def compute_many(
+    kbbs: List[KBB], 
+    msg: Union[str, None] = None, 
+    embeddings: Union[Dict[str, np.ndarray], None] = None
+):
+    """
+    Compute several KBBs concurrently, skipping the ones already computed.
+
+    The computations are independent and mostly wait for the LLM and the 
+    database, so they run in a thread pool of at most `compute_parallelism()` 
+    threads (set with the KBGIT_COMPUTE_PARALLELISM environment variable).
+
+    Args:
+        kbbs (List[KBB]): The KBBs to be computed.
+        msg (Union[str, None], optional): An optional message to attach to 
+            the computation log. Defaults to None.
+        embeddings (Union[Dict[str, np.ndarray], None], optional): The 
+            embeddings of the contents of some KBBs, keyed by KBB ID, if 
+            already known, see `KBB.compute`. Defaults to None.
+    """
+    dict_embeddings = embeddings if embeddings is not None else {}
+    list_uncomputed = [kbb for kbb in kbbs if kbb.data["state"] != "computed"]
+    if len(list_uncomputed) == 1:
+        list_uncomputed[0].ensure_computed(
+            msg=msg, 
+            embedding=dict_embeddings.get(list_uncomputed[0].data["kbb_id"])
+        )
+    elif len(list_uncomputed) > 1:
+        with ThreadPoolExecutor(
+            max_workers=min(compute_parallelism(), len(list_uncomputed))
+        ) as executor:
+            list(executor.map(
+                lambda kbb: kbb.ensure_computed(
+                    msg=msg, 
+                    embedding=dict_embeddings.get(kbb.data["kbb_id"])
+                ), 
+                list_uncomputed
+            ))
+
+
+def _pull_kbbs_from_db(
+        kbb_ids: List[str], 
+        include_embeddings: bool = True
+    ) -> Dict[str, KBB]:
+    """
+    Retrieve several KBBs from the database with a single call.
+
+    Args:
+        kbb_ids (list): The IDs of the KBBs to be retrieved. Duplicated IDs 
+            are fetched only once.
+        include_embeddings (bool, optional): Whether to retrieve the 
+            embeddings too. The KBBs used only for display do not need them. 
+            Defaults to True.
+
+    Returns:
+        dict: The retrieved KBBs, keyed by the requested IDs.
+    """
+    list_unique_ids = list(dict.fromkeys(kbb_ids))
+    db_connection = get_db_connection()
+    dict_kbbs = {}
+    for kbb_id, kbb_data in zip(
+        list_unique_ids, 
+        db_connection.kbb_search_by_ids(
+            list_unique_ids, 
+            include_embeddings=include_embeddings
+        )
+    ):
+        if "embedding" in kbb_data:
+            kbb_data["embedding"] = np.asarray(
+                kbb_data["embedding"], dtype=np.float32
+            )
+        dict_kbbs[kbb_id] = KBB(kbb_data=kbb_data)
+    return dict_kbbs
+
+
+def _rewrite_contents(list_contents: List[str], list_indices: List[int]):
+    """
+    Rewrite some of the given contents in place with a single batched call.
+
+    Args:
+        list_contents (list): The contents of the parent KBBs.
+        list_indices (list): The indices of the contents to be rewritten.
+    """
+    if len(list_indices) == 0:
+        return
+    from ..llm import llm_text_rewrite_batch
+    list_outputs = llm_text_rewrite_batch(
+        texts=[list_contents[i] for i in list_indices]
+    )
+    for i, dict_output in zip(list_indices, list_outputs):
+        list_contents[i] = dict_output["parsed_output"]
+
+
 def fixed_length_list(
         list_strings: List[str], 
         l: int=100, 
@@ -568,22 +831,56 @@ def fixed_length_list(
             within the specified length. If a string exceeds the maximum 
             length and cannot be adjusted, it adds "[...]".
     """
-    new_list = []
+    return list(_iter_fixed_length(
+        list_strings=list_strings, 
+        l=l, 
+        additional_space=additional_space
+    ))
+
+
+def _iter_fixed_length(
+        list_strings: List[str], 
+        l: int=100, 
+        additional_space: int=4
+    ) -> Iterator[str]:
+    """
+    Yield the fixed length rows produced by `fixed_length_list`.
+
+    Each row is sliced at integer offsets, so that long rows are split 
+    without rebuilding the remaining part of the string at every step.
+
+    Args:
+        list_strings (list): A list of strings to be processed.
+        l (int, optional): The maximum length for each string. 
+            Defaults to 100.
+        additional_space (int, optional): The additional spaces to 
+            prepend for formatting. Defaults to 4.
+
+    Yields:
+        str: The adjusted strings, each fitting within the specified length.
+    """
     for _, row in enumerate(list_strings):
-        initial_white_space = len(row) - len(row.lstrip())
-        total_space = (initial_white_space + additional_space) * " "
-        if len(total_space) >= l-20:
-            new_list.append("[...]")
-            break
-        tmp = row
-        while len(tmp) > l:
-            new_list.append(tmp[:l])
-            if _ > 0:
-                tmp =  total_space + tmp[l:]
-            else:
-                tmp = tmp[l:]
-        new_list.append(tmp)
-    return new_list
+        # Only the width of the indentation is needed to decide whether the 
+        # row fits, the padding string is built for wrapped rows only.
+        n_spaces = len(row) - len(row.lstrip()) + additional_space
+        if n_spaces >= l-20:
+            yield "[...]"
+            return
+        if len(row) <= l:
+            yield row
+            continue
+        yield row[:l]
+        if _ > 0:
+            prefix = n_spaces * " "
+            chunk = l - n_spaces
+        else:
+            prefix = ""
+            chunk = l
+        off = l
+        while len(row) - off > chunk:
+            yield prefix + row[off:off+chunk]
+            off += chunk
+        yield prefix + row[off:]
 
                 
 
@@ -1,8 +1,16 @@
+import sys
 from uuid import uuid4
 from time import time
-from typing import Dict, List, Union, Any, Self
+import numpy as np
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Union, Any, Self
 from ..db.tools import get_db_connection
-from .block import KBB
+from .block import KBB, compute_many, _pull_kbbs_from_db
+
+
+# Up to this number of KBBs, the similarity search within a KBD is done in 
+# memory by brute force; larger KBDs are searched with the database index.
+ANN_MIN_VECTORS = 50000
 
 
 class KBD:
@@ -13,9 +21,26 @@ class KBD:
     allowing the user to perform operations such as adding, removing, and
     searching for KBB entries. It manages the relationships between KBB entries
     and can retrieve information from the Document.
+
+    The state of the KBD is kept in slots (`kbd_id`, `kbbs`, `kbb_ids`, 
+    `operations` and `state`), `data` returns it as a dictionary.
     """
 
-    def __init__(self, kbbs: List[KBB] = [], kbd_id: Union[str, None] = None):
+    __slots__ = (
+        "kbd_id", 
+        "kbbs", 
+        "kbb_ids", 
+        "operations", 
+        "state", 
+        "_kbb_id_set", 
+        "_embedding_index_cache"
+    )
+
+    def __init__(
+        self, 
+        kbbs: Union[List[KBB], None] = None, 
+        kbd_id: Union[str, None] = None
+    ):
         """
         Initialize a KBD instance.
 
@@ -24,40 +49,72 @@ class KBD:
         provided, or initializes a new KBD entry if KBBs are provided.
 
         Args:
-            kbbs (List[KBB], optional): A list of KBB objects associated with 
-                this KBD.
+            kbbs (Union[List[KBB], None], optional): A list of KBB objects 
+                associated with this KBD. The list is copied. Defaults to None.
             kbd_id (Union[str, None], optional): The ID of an existing KBD to 
                 initialize from.
         """
-        self.data: Dict[str, Any] = {}
-        if len(kbbs) > 0:
-            self.data["kbd_id"] = f"kbd_{uuid4()}"
-            self.data["kbbs"] = kbbs
-            self.data["kbb_ids"] = [_.data["kbb_id"] for _ in kbbs]
-            self.data["operations"] = [
+        if kbbs:
+            self.kbd_id = f"kbd_{uuid4().hex}"
+            self.kbbs = []
+            self.kbb_ids = []
+            for _ in kbbs:
+                self.kbbs.append(_)
+                self.kbb_ids.append(_.data["kbb_id"])
+            self.operations = [
                 {
                     "operation": "create", 
-                    "kbbs_snapshot": [_.data["kbb_id"] for _ in kbbs], 
+                    "kbbs_snapshot": list(self.kbb_ids), 
                     "tms": time()
                 }
             ]
-            self.data["state"] = "uncomputed"
+            self.state = "uncomputed"
         elif kbd_id is not None:
             db_connection = get_db_connection()
-            self.data = db_connection.kbd_search_by_id(self, kbd_id)
-            self.data["kbbs"] = [KBB(kbb_id=_) for _ in self.data["kbb_ids"]]
+            kbd_data = db_connection.kbd_search_by_id(kbd_id)
+            self.kbd_id = kbd_data["kbd_id"]
+            self.kbb_ids = [sys.intern(_) for _ in kbd_data["kbb_ids"]]
+            self.operations = kbd_data["operations"]
+            for operation in self.operations:
+                for key in ("kbbs_snapshot", "kbb", "kbb_removed"):
+                    if key in operation:
+                        operation[key] = [sys.intern(_) for _ in operation[key]]
+            self.state = kbd_data["state"]
+            # Pulled as the KBBs of the other paths, with float32 embeddings.
+            dict_kbbs = _pull_kbbs_from_db(self.kbb_ids)
+            self.kbbs = [dict_kbbs[_] for _ in self.kbb_ids]
         else:
-            self.data["kbd_id"] = f"kbd_{uuid4()}"
-            self.data["kbbs"] = []
-            self.data["kbb_ids"] = []
-            self.data["operations"] = [
+            self.kbd_id = f"kbd_{uuid4().hex}"
+            self.kbbs = []
+            self.kbb_ids = []
+            self.operations = [
                 {
                     "operation": "create", 
                     "kbbs_snapshot": [], 
                     "tms": time()
                 }
             ]
-            self.data["state"] = "uncomputed"            
+            self.state = "uncomputed"
+        # Set of `kbb_ids`, kept in sync with it for fast membership tests.
+        self._kbb_id_set = set(self.kbb_ids)
+
+    @property
+    def data(self) -> Mapping[str, Any]:
+        """
+        Return the state of the KBD as a read-only mapping, e.g. to be stored 
+        in the database. The lists are shared with the KBD, not copied.
+
+        The mapping is built from the slots at each access, so it cannot be 
+        used to update the KBD: writing to it raises a TypeError. The slot 
+        attributes (e.g. `kbd.state`) are updated instead.
+        """
+        return MappingProxyType({
+            "kbd_id": self.kbd_id,
+            "kbbs": self.kbbs,
+            "kbb_ids": self.kbb_ids,
+            "operations": self.operations,
+            "state": self.state,
+        })
 
     def __add__(self, kbd: Self) -> "KBD": 
         """
@@ -72,22 +129,21 @@ class KBD:
         Returns:
             KBD: A new KBD instance that combines the KBBs of both instances.
         """
-        new_kbd = KBD(
-            kbbs = self.data["kbbs"] + \
-                [_ for _ in kbd.data["kbbs"] \
-                 if _.data["kbb_id"] not in self.data["kbb_ids"]]
-        )
-        new_kbd.data["operations"][0]["operation"] = "sum"
+        dict_kbbs: Dict[str, KBB] = {}
+        for _ in self.kbbs + kbd.kbbs:
+            dict_kbbs.setdefault(_.data["kbb_id"], _)
+        new_kbd = KBD(kbbs=list(dict_kbbs.values()))
+        new_kbd.operations[0]["operation"] = "sum"
         list_parents: List[str] = []
-        if (self.data["state"] == "uncomputed") and (self.data["operations"][-1]["operation"] == "sum"):
-            list_parents = list_parents + self.data["operations"][-1]["parents_kbd"]
+        if (self.state == "uncomputed") and (self.operations[-1]["operation"] == "sum"):
+            list_parents = list_parents + self.operations[-1]["parents_kbd"]
         else:
-            list_parents.append(self.data["kbd_id"])
-        if (kbd.data["state"] == "uncomputed") and (kbd.data["operations"][-1]["operation"] == "sum"):
-            list_parents = list_parents + kbd.data["operations"][-1]["parents_kbd"]
+            list_parents.append(self.kbd_id)
+        if (kbd.state == "uncomputed") and (kbd.operations[-1]["operation"] == "sum"):
+            list_parents = list_parents + kbd.operations[-1]["parents_kbd"]
         else:
-            list_parents.append(kbd.data["kbd_id"])
-        new_kbd.data["operations"][0]["parents_kbd"] = list_parents
+            list_parents.append(kbd.kbd_id)
+        new_kbd.operations[0]["parents_kbd"] = list_parents
         return new_kbd
     
     def __radd__(self, kbd: Self) -> "KBD":
@@ -113,10 +169,10 @@ class KBD:
             KBD: A new KBD instance that contains KBBs from this instance
             excluding those in the given KBD.
         """
-        new_kbbs = [_ for _ in self.data["kbbs"] if _.data["kbb_id"] not in kbd.data["kbb_ids"]]
+        new_kbbs = [_ for _ in self.kbbs if _.data["kbb_id"] not in kbd._kbb_id_set]
         new_kbd = KBD(kbbs=new_kbbs)
-        new_kbd.data["operations"][0]["operation"] = "sub"
-        new_kbd.data["operations"][0]["parents_kbd"] = [self.data["kbd_id"], kbd.data["kbd_id"]]
+        new_kbd.operations[0]["operation"] = "sub"
+        new_kbd.operations[0]["parents_kbd"] = [self.kbd_id, kbd.kbd_id]
         return new_kbd
         
     def __lt__(self, kbb: KBB):
@@ -128,19 +184,19 @@ class KBD:
         Args:
             kbb (KBB): The KBB instance to add.
         """
-        assert kbb.data["kbb_id"] not in self.data["kbb_ids"], \
+        assert kbb.data["kbb_id"] not in self._kbb_id_set, \
             "KBB already in DOC."
-        self.data["kbbs"].append(kbb)
-        self.data["kbb_ids"].append(kbb.data["kbb_id"])
-        self.data["operations"].append(
+        self.kbbs.append(kbb)
+        self.kbb_ids.append(kbb.data["kbb_id"])
+        self._kbb_id_set.add(kbb.data["kbb_id"])
+        self.operations.append(
             {
                 "operation": "add", 
                 "kbb": [kbb.data["kbb_id"]], 
-                "kbbs_snapshot": self.data["kbb_ids"].copy(), 
                 "tms": time()
             }
         )
-        self.data["state"] = "uncomputed"
+        self.state = "uncomputed"
 
     def __lshift__(self, kbb: KBB):
         """
@@ -152,35 +208,74 @@ class KBD:
         Args:
             kbb (KBB): The KBB instance to add.
         """
-        assert kbb.data["kbb_id"] not in self.data["kbb_ids"], \
+        assert kbb.data["kbb_id"] not in self._kbb_id_set, \
             "KBB already in DOC."
-        for _ in self.data["kbbs"]:
-            if _.data["state"] != "computed":
-                _.compute()
+        compute_many(self.kbbs)
         db_connection = get_db_connection()
         list_similar_kbb_data = db_connection.kbb_search_by_text(
             text=kbb.data["content"], 
-            kbb_ids_to_query=self.data["kbb_ids"], 
+            kbb_ids_to_query=self._kbb_id_set, 
             distance=1.0, 
             n_results=1
         )
         new_kbb = kbb
+        list_removed = []
         if len(list_similar_kbb_data) > 0:
             similar_kbb = KBB(kbb_data=list_similar_kbb_data[0][1])
             new_kbb = similar_kbb + kbb
-            self.data["kbbs"] = [_ for _ in self.data["kbbs"] if _.data["kbb_id"] != similar_kbb.data["kbb_id"]]
-            self.data["kbb_ids"].remove(similar_kbb.data["kbb_id"])
-        self.data["kbbs"].append(new_kbb)
-        self.data["kbb_ids"].append(new_kbb.data["kbb_id"])
-        self.data["operations"].append(
+            list_kbbs, list_kbb_ids = [], []
+            for _ in self.kbbs:
+                if _.data["kbb_id"] != similar_kbb.data["kbb_id"]:
+                    list_kbbs.append(_)
+                    list_kbb_ids.append(_.data["kbb_id"])
+            self.kbbs = list_kbbs
+            self.kbb_ids = list_kbb_ids
+            self._kbb_id_set.discard(similar_kbb.data["kbb_id"])
+            list_removed.append(similar_kbb.data["kbb_id"])
+        self.kbbs.append(new_kbb)
+        self.kbb_ids.append(new_kbb.data["kbb_id"])
+        self._kbb_id_set.add(new_kbb.data["kbb_id"])
+        self.operations.append(
             {
                 "operation": "smart add", 
                 "kbb": [new_kbb.data["kbb_id"]], 
-                "kbbs_snapshot": self.data["kbb_ids"].copy(), 
+                "kbb_removed": list_removed, 
                 "tms": time()
             }
         )
-        self.data["state"] = "uncomputed"
+        self.state = "uncomputed"
+
+    def snapshot_at(self, op_index: int = -1) -> List[str]:
+        """
+        Return the IDs of the KBBs in the KBD right after an operation.
+
+        Only the operations creating a KBD store the full list of KBB IDs, 
+        the following additions store what they changed. The list is rebuilt 
+        by replaying the operations from the last full snapshot.
+
+        Args:
+            op_index (int, optional): The index of the operation in 
+                `operations`. Negative indices count from the end. 
+                Defaults to -1, the last operation.
+
+        Returns:
+            List[str]: The KBB IDs contained in the KBD after the operation.
+        """
+        list_operations = self.operations
+        if op_index < 0:
+            op_index += len(list_operations)
+        assert 0 <= op_index < len(list_operations), \
+            "Operation index out of range."
+        start = op_index
+        while "kbbs_snapshot" not in list_operations[start]:
+            start -= 1
+        list_kbb_ids = list(list_operations[start]["kbbs_snapshot"])
+        for operation in list_operations[start+1:op_index+1]:
+            set_removed = set(operation.get("kbb_removed", []))
+            if len(set_removed) > 0:
+                list_kbb_ids = [_ for _ in list_kbb_ids if _ not in set_removed]
+            list_kbb_ids.extend(operation["kbb"])
+        return list_kbb_ids
 
     def __str__(self) -> str:
         """
@@ -192,12 +287,11 @@ class KBD:
         Returns:
             str: A formatted string representing the contents of the KBD.
         """
-        output = ""
-        for kbb in self.data["kbbs"]:
-            if kbb.data["state"] != "computed":
-                kbb.compute()
-            output = output + f"[{kbb.data['kbb_id']}] {kbb.data['content']} \n"
-        return output
+        compute_many(self.kbbs)
+        return "".join(
+            f"[{kbb.data['kbb_id']}] {kbb.data['content']} \n" 
+            for kbb in self.kbbs
+        )
 
     def search_similar_kbb(
         self, 
@@ -209,7 +303,9 @@ class KBD:
         Search for similar KBB entries based on the content of a given KBB.
 
         This method compares the contents of the provided KBB against all KBBs
-        in the KBD and retrieves similar entries.
+        in the KBD and retrieves similar entries. KBDs with less than 
+        `ANN_MIN_VECTORS` KBBs are searched in memory, by brute force on their 
+        embeddings, the larger ones through the database index.
 
         Args:
             kbb (KBB): The KBB instance to compare against.
@@ -223,16 +319,78 @@ class KBD:
         """
         if kbb.data["state"] != "computed":
             kbb.compute()
-        if self.data["state"] != "computed":
+        if self.state != "computed":
             self.compute()
+        index = self._embedding_index()
+        query = np.asarray(kbb.data["embedding"], dtype=np.float32)
+        if (index is not None) and (index[0].shape[1] == query.shape[0]):
+            matrix, sq_norms = index
+            # Squared L2 distances (the metric of the KBB collection) from a 
+            # single float32 matrix-vector product, which runs on BLAS.
+            distances = sq_norms - 2 * (matrix @ query) + float(query @ query)
+            # The best candidates are then rescored directly on the 
+            # embeddings, to avoid the rounding errors of the expansion.
+            n_candidates = min(len(distances), max(4 * n_results, 16))
+            candidates = np.argpartition(
+                distances, n_candidates - 1
+            )[:n_candidates]
+            exact_distances = [
+                float(np.sum(np.square(
+                    np.asarray(
+                        self.kbbs[i].data["embedding"], 
+                        dtype=np.float32
+                    ) - query
+                ))) 
+                for i in candidates
+            ]
+            order = np.argsort(exact_distances, kind="stable")
+            return [
+                (
+                    exact_distances[j], 
+                    {
+                        k: v 
+                        for k, v in self.kbbs[candidates[j]].data.items() 
+                        if k != "embedding"
+                    }
+                ) 
+                for j in order if exact_distances[j] <= distance
+            ][:n_results]
         db_connection = get_db_connection()
-        list_similar_kbb_data = db_connection.kbb_serach_by_text(
+        list_similar_kbb_data = db_connection.kbb_search_by_text(
             kbb.data["content"], 
-            ids_to_query=self.data["kbb_ids"], 
+            kbb_ids_to_query=self._kbb_id_set, 
             distance=distance, 
             n_results=n_results
         )
         return list_similar_kbb_data
+
+    def _embedding_index(self) -> Union[tuple, None]:
+        """
+        Return the float32 matrix of the embeddings of the KBBs of the KBD.
+
+        The index is cached until the list of KBBs changes.
+
+        Returns:
+            tuple or None: The float32 matrix with one row per KBB (in the 
+                same order as `kbbs`) and the squared norm of each embedding. 
+                None if the KBD is empty, too large for a brute-force search, 
+                or its embeddings have different sizes.
+        """
+        kbb_ids = tuple(self.kbb_ids)
+        cache = getattr(self, "_embedding_index_cache", None)
+        if (cache is not None) and (cache[0] == kbb_ids):
+            return cache[1]
+        list_embeddings = [
+            np.asarray(_.data["embedding"], dtype=np.float32) 
+            for _ in self.kbbs
+        ]
+        index = None
+        if (0 < len(list_embeddings) < ANN_MIN_VECTORS) and \
+            (len({_.shape for _ in list_embeddings}) == 1):
+            matrix = np.stack(list_embeddings)
+            index = (matrix, (matrix * matrix).sum(axis=1))
+        self._embedding_index_cache = (kbb_ids, index)
+        return index
         
     def compute(self):
         """
@@ -240,11 +398,31 @@ class KBD:
 
         This method ensures that all KBB entries are computed and updates the 
         state of the KBD to 'computed'. It also updates the KBD in the database.
+        The embeddings of the uncomputed KBBs whose content is already known 
+        are retrieved first, with batched calls, and passed to the KBBs 
+        (bypassing the in-memory cache, which a large KBD would overflow). 
+        Then the KBBs are computed concurrently.
         """
-        for kbb in self.data["kbbs"]:
-            if kbb.data["state"] != "computed":
-                kbb.compute()
-        self.data["state"] = "computed"
+        from ..llm import get_embeddings_cached
         db_connection = get_db_connection()
+        list_uncomputed = [
+            kbb for kbb in self.kbbs if kbb.data["state"] != "computed"
+        ]
+        list_known = [
+            kbb for kbb in list_uncomputed 
+            if kbb.data["parents_op"] not in ["sum", "sub"]
+        ]
+        dict_embeddings = {}
+        if len(list_known) > 1:
+            list_embeddings = get_embeddings_cached(
+                [kbb.data["content"] for kbb in list_known], 
+                lookup=db_connection.kbb_embedding_by_hash, 
+                store=False
+            )
+            dict_embeddings = {
+                kbb.data["kbb_id"]: embedding 
+                for kbb, embedding in zip(list_known, list_embeddings)
+            }
+        compute_many(list_uncomputed, embeddings=dict_embeddings)
+        self.state = "computed"
         db_connection.kbd_update(self)
-
@@ -1,17 +1,63 @@
 import re
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Union
+import numpy as np
+import orjson
 from openai import OpenAI # type: ignore
 from ollama import chat as ollama_chat # type: ignore
-import os
+from .config import embedding_output_size, get_setting
 from .log import logger
 from .prompts.kbb import (
     PROMPT_KBB_REWRITE, 
     PROMPT_KBB_SUB, 
     PROMPT_KBB_CONFLICTS, 
+    PROMPT_KBB_CONFLICTS_BATCH, 
     PROMPT_KBB_CORRECT
 )
 
 
-def get_embedding(text: str, model : str = "text-embedding-3-small") -> list:
+# The prompt templates are split on their placeholders once, so that each 
+# prompt is built by joining the parts with the texts.
+_PROMPT_PARTS_REWRITE = PROMPT_KBB_REWRITE.split("%s")
+_PROMPT_PARTS_SUB = PROMPT_KBB_SUB.split("%s")
+_PROMPT_PARTS_CONFLICTS = PROMPT_KBB_CONFLICTS.split("%s")
+_PROMPT_PARTS_CONFLICTS_BATCH = PROMPT_KBB_CONFLICTS_BATCH.split("%s")
+_PROMPT_PARTS_CORRECT = PROMPT_KBB_CORRECT.split("%s")
+
+
+def _fill_prompt(parts: List[str], *texts: str) -> str:
+    """
+    Build a prompt from the parts of its template and the texts to insert.
+    """
+    list_pieces = [parts[0]]
+    for text, part in zip(texts, parts[1:]):
+        list_pieces.append(str(text))
+        list_pieces.append(part)
+    return "".join(list_pieces)
+
+
+@lru_cache(maxsize=4)
+def _openai_client(api_key: Union[str, None]) -> OpenAI:
+    """
+    Return the OpenAI client for an API key, creating it on first use.
+
+    The client is shared by all the calls, so that its HTTP connection pool 
+    (and the keep-alive connections) is reused.
+
+    Args:
+        api_key (str): The OpenAI API key.
+
+    Returns:
+        OpenAI: The OpenAI client.
+    """
+    return OpenAI(api_key=api_key)
+
+
+def get_embedding(text: str, model : str = "text-embedding-3-small") -> np.ndarray:
     """
     Retrieve the embedding for a given text using the specified model.
 
@@ -21,108 +67,578 @@ def get_embedding(text: str, model : str = "text-embedding-3-small") -> list:
             Defaults to "text-embedding-3-small".
 
     Returns:
-        list: A list representing the embedding vector for the input text. 
-              Returns a list of zeros if the input text is empty.
+        np.ndarray: A float32 array representing the embedding vector for the 
+              input text. Returns an array of zeros if the input text is empty.
     """
     # TODO. Add support for other embedding models. 
     if len(text) > 0:
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        client = _openai_client(get_setting("OPENAI_API_KEY"))
         emb_output = client.embeddings.create(
             input = [text], 
             model = model
         ).data[0].embedding
-        return emb_output
+        return np.asarray(emb_output, dtype=np.float32)
     else:
-        EMBEDDING_OUTPUT_SIZE = os.getenv("EMBEDDING_OUTPUT_SIZE")
-        if (EMBEDDING_OUTPUT_SIZE is None) or (EMBEDDING_OUTPUT_SIZE == ""):
-            emb_output_size = 1
-        else:
-            emb_output_size = int(EMBEDDING_OUTPUT_SIZE)
-        return [0] * emb_output_size
+        return np.zeros(embedding_output_size(), dtype=np.float32)
+
+
+# Limits of a single request to the embeddings endpoint: number of inputs and 
+# total tokens (estimated from the length of the texts, see 
+# `_embedding_chunks`).
+EMBEDDING_MAX_INPUTS = 2048
+EMBEDDING_MAX_TOKENS = 300000
+
+
+def _embedding_chunks(texts: List[str], indices: List[int]) -> List[List[int]]:
+    """
+    Split the indices of the texts to embed into the chunks sent with each 
+    request, of at most EMBEDDING_MAX_INPUTS texts and EMBEDDING_MAX_TOKENS 
+    tokens. The tokens are overestimated as one every 3 characters.
+    """
+    list_chunks: List[List[int]] = []
+    list_chunk: List[int] = []
+    n_tokens = 0
+    for i in indices:
+        n_text_tokens = len(texts[i]) // 3 + 1
+        if (len(list_chunk) == EMBEDDING_MAX_INPUTS) or \
+            (len(list_chunk) > 0 and n_tokens + n_text_tokens > EMBEDDING_MAX_TOKENS):
+            list_chunks.append(list_chunk)
+            list_chunk, n_tokens = [], 0
+        list_chunk.append(i)
+        n_tokens += n_text_tokens
+    if len(list_chunk) > 0:
+        list_chunks.append(list_chunk)
+    return list_chunks
+
+
+def get_embeddings(
+    texts: List[str], 
+    model : str = "text-embedding-3-small"
+) -> List[np.ndarray]:
+    """
+    Retrieve the embeddings for several texts with batched API calls.
+
+    The texts are sent in as few requests as the limits of the embeddings 
+    endpoint allow (see `_embedding_chunks`), usually a single one.
+
+    Args:
+        texts (List[str]): The input texts for which to generate the 
+            embeddings.
+        model (str, optional): The embedding model to use. 
+            Defaults to "text-embedding-3-small".
+
+    Returns:
+        List[np.ndarray]: The float32 embedding vectors, in the same order as 
+            `texts`. Empty texts get an array of zeros, as in `get_embedding`.
+    """
+    list_embeddings = [None] * len(texts)
+    list_indices = [i for i, text in enumerate(texts) if len(text) > 0]
+    if len(list_indices) > 0:
+        client = _openai_client(get_setting("OPENAI_API_KEY"))
+        for list_chunk in _embedding_chunks(texts, list_indices):
+            emb_output = client.embeddings.create(
+                input = [texts[i] for i in list_chunk], 
+                model = model
+            ).data
+            for i, emb in zip(list_chunk, emb_output):
+                list_embeddings[i] = np.asarray(emb.embedding, dtype=np.float32)
+    for i, text in enumerate(texts):
+        if len(text) == 0:
+            list_embeddings[i] = get_embedding(text, model=model)
+    return list_embeddings
+
+
+def content_hash(text: str) -> str:
+    """
+    Compute the SHA-256 hash of a text.
 
+    Args:
+        text (str): The input text.
+
+    Returns:
+        str: The hexadecimal digest of the text.
+    """
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class LRUCache:
+    """
+    LRUCache class stores values already computed in memory.
+
+    The values are keyed by hashable keys (e.g. the model and the SHA-256 
+    hash of a text), and the least recently used ones are evicted when the 
+    cache is full. The cache can be shared by several threads.
+    """
 
+    def __init__(self, maxsize: int = 4096):
+        """
+        Initialize an LRUCache instance.
 
+        Args:
+            maxsize (int, optional): The maximum number of values to keep. 
+                Defaults to 4096.
+        """
+        self.maxsize = maxsize
+        self._values: OrderedDict = OrderedDict()
+        self._lock = Lock()
 
-def make_llm_call(text: str, expected: str = "", attempts: int = 3) -> str:
+    def get(self, key: tuple) -> Any:
+        """
+        Return the cached value for a key, or None if it is missing.
+        """
+        with self._lock:
+            value = self._values.get(key)
+            if value is not None:
+                self._values.move_to_end(key)
+            return value
+
+    def put(self, key: tuple, value: Any):
+        """
+        Store a value, evicting the least recently used one if needed.
+        """
+        with self._lock:
+            self._values[key] = value
+            self._values.move_to_end(key)
+            if len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+
+
+EMBEDDING_CACHE = LRUCache()
+
+# Results of the KBB operations, keyed by the hash of the operation and of 
+# its input contents.
+OP_RESULT_CACHE = LRUCache(maxsize=1024)
+
+# Accepted LLM responses, keyed by the hash of the provider, the model and 
+# the prompt.
+LLM_RESPONSE_CACHE = LRUCache(maxsize=1024)
+
+
+def get_embedding_cached(
+    text: str, 
+    model: str = "text-embedding-3-small", 
+    lookup: Union[Callable[[str], Any], None] = None
+) -> np.ndarray:
+    """
+    Retrieve the embedding for a given text, reusing the cached embeddings.
+
+    The in-memory cache is checked first. On a miss, the optional `lookup` 
+    function is called with the hash of the text (e.g. to reuse an embedding 
+    already stored in the database), and only then the embedding model is 
+    called.
+
+    Args:
+        text (str): The input text for which to generate the embedding.
+        model (str, optional): The embedding model to use. 
+            Defaults to "text-embedding-3-small".
+        lookup (Callable, optional): A function returning the embedding of 
+            the text given its hash, or None if it is unknown. 
+            Defaults to None.
+
+    Returns:
+        np.ndarray: A float32 array representing the embedding vector for the 
+            input text.
+    """
+    text_hash = content_hash(text)
+    key = (model, text_hash)
+    embedding = EMBEDDING_CACHE.get(key)
+    if embedding is None:
+        if lookup is not None:
+            embedding = lookup(text_hash)
+        if embedding is None:
+            embedding = get_embedding(text, model=model)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        EMBEDDING_CACHE.put(key, embedding)
+    return embedding
+
+
+def get_embeddings_cached(
+    texts: List[str], 
+    model: str = "text-embedding-3-small", 
+    lookup: Union[Callable[[str], Any], None] = None, 
+    store: bool = True
+) -> List[np.ndarray]:
+    """
+    Retrieve the embeddings for several texts, reusing the cached embeddings.
+
+    This function works as `get_embedding_cached` on each of the given texts, 
+    but the embeddings missing from both the cache and `lookup` are 
+    requested together with `get_embeddings`.
+
+    Args:
+        texts (List[str]): The input texts for which to generate the 
+            embeddings.
+        model (str, optional): The embedding model to use. 
+            Defaults to "text-embedding-3-small".
+        lookup (Callable, optional): A function returning the embedding of 
+            a text given its hash, or None if it is unknown. 
+            Defaults to None.
+        store (bool, optional): Whether to store the retrieved embeddings in 
+            the in-memory cache. Callers using the embeddings right away 
+            (e.g. many at once, which would evict each other) can skip it. 
+            Defaults to True.
+
+    Returns:
+        List[np.ndarray]: The float32 embedding vectors, in the same order as 
+            `texts`.
+    """
+    list_embeddings = []
+    dict_missing: dict = {}
+    for i, text in enumerate(texts):
+        text_hash = content_hash(text)
+        embedding = EMBEDDING_CACHE.get((model, text_hash))
+        if embedding is None and lookup is not None:
+            embedding = lookup(text_hash)
+            if embedding is not None:
+                embedding = np.asarray(embedding, dtype=np.float32)
+                if store:
+                    EMBEDDING_CACHE.put((model, text_hash), embedding)
+        if embedding is None:
+            dict_missing.setdefault(text, []).append(i)
+        list_embeddings.append(embedding)
+    if len(dict_missing) > 0:
+        list_texts = list(dict_missing.keys())
+        for text, embedding in zip(
+            list_texts, get_embeddings(list_texts, model=model)
+        ):
+            if store:
+                EMBEDDING_CACHE.put((model, content_hash(text)), embedding)
+            for i in dict_missing[text]:
+                list_embeddings[i] = embedding
+    return list_embeddings
+
+
+def op_result_key(operation: str, contents: List[str]) -> str:
+    """
+    Compute the cache key of a KBB operation on the given contents.
+
+    Args:
+        operation (str): The name of the operation (e.g. "sum" or "sub").
+        contents (List[str]): The input contents of the operation, in the 
+            order in which they are given to the language model.
+
+    Returns:
+        str: The SHA-256 hash of the operation and of its contents.
+    """
+    return content_hash("\x00".join([operation] + list(contents)))
+
+
+def llm_op_cached(
+    operation: str, 
+    contents: List[str], 
+    call: Callable[[], dict], 
+    lookup: Union[Callable[[str], Any], None] = None, 
+    store: Union[Callable[[str, dict], Any], None] = None
+) -> dict:
+    """
+    Return the result of a KBB operation, reusing the results already known.
+
+    The in-memory cache is checked first, then the optional `lookup` 
+    function (e.g. to reuse a result stored in the database), and only then 
+    `call` is made. New results with a non-empty parsed output are passed to 
+    the optional `store` function.
+
+    Args:
+        operation (str): The name of the operation (e.g. "sum" or "sub").
+        contents (List[str]): The input contents of the operation.
+        call (Callable): A function computing the result of the operation, 
+            e.g. a call to `llm_text_rewrite`.
+        lookup (Callable, optional): A function returning the result given 
+            its key, or None if it is unknown. Defaults to None.
+        store (Callable, optional): A function storing a result given its 
+            key. Defaults to None.
+
+    Returns:
+        dict: A dictionary with the "raw_output" and the "parsed_output" of 
+            the operation.
+    """
+    key = op_result_key(operation, contents)
+    result = OP_RESULT_CACHE.get(key)
+    if result is None and lookup is not None:
+        result = lookup(key)
+    if result is None:
+        result = call()
+        if not result["parsed_output"]:
+            return result
+        if store is not None:
+            store(key, result)
+    else:
+        logger.debug(f"Result of {operation} {key} reused.")
+    OP_RESULT_CACHE.put(key, result)
+    return result
+
+
+def _read_stream(
+    stream: Any, 
+    expected: str = "", 
+    stop_early: bool = False
+) -> str:
+    """
+    Read a streamed chat completion, optionally stopping as soon as the 
+    answer is there.
+
+    With `stop_early`, when `expected` is an opening tag (e.g. "<OUTPUT>"), 
+    the stream is closed as soon as the matching closing tag follows it, 
+    without waiting for the rest of the completion. This is only safe for 
+    prompts whose answers cannot mention the tags before the actual output 
+    (`parse_output` keeps the last match, which would be cut off). Otherwise 
+    the whole completion is read.
+
+    Args:
+        stream: The stream returned by the OpenAI client with `stream=True`.
+        expected (str, optional): The substring the answer should contain. 
+            Defaults to "".
+        stop_early (bool, optional): Whether to close the stream at the 
+            first closing tag. Defaults to False.
+
+    Returns:
+        str: The content received from the LLM.
+    """
+    closing_tag = "</" + expected[1:] \
+        if stop_early and expected.startswith("<") else ""
+    response_content = ""
+    start = -1
+    for chunk in stream:
+        if (len(chunk.choices) > 0) and \
+            (chunk.choices[0].finish_reason == "length"):
+            logger.warning("LLM answer truncated at the max_tokens limit.")
+        if (len(chunk.choices) == 0) or (not chunk.choices[0].delta.content):
+            continue
+        delta = chunk.choices[0].delta.content
+        response_content += delta
+        if closing_tag == "":
+            continue
+        # Only the new content (and the end of the previous one, where a tag 
+        # may have been split) needs to be searched.
+        offset = max(0, len(response_content) - len(delta) - len(closing_tag))
+        if start < 0:
+            start = response_content.find(expected, offset)
+            if start >= 0:
+                offset = start + len(expected)
+        if (start >= 0) and (response_content.find(closing_tag, offset) >= 0):
+            stream.close()
+            break
+    return response_content
+
+
+def _answer_complete(response_content: str, expected: str = "") -> bool:
+    """
+    Whether an LLM answer contains the expected substring and, when this is 
+    an opening tag (e.g. "<OUTPUT>"), the matching closing tag after it. An 
+    answer truncated within the tags is not complete.
+    """
+    start = response_content.find(expected)
+    if start < 0:
+        return False
+    if not expected.startswith("<"):
+        return True
+    closing_tag = "</" + expected[1:]
+    return response_content.find(closing_tag, start + len(expected)) >= 0
+
+
+# Upper bound on the tokens generated by a single LLM call. 
+MAX_TOKENS = 2048
+
+# Lower bound on the cap of the tokens, leaving room for the step by step 
+# reasoning and the output tags of short texts.
+MIN_MAX_TOKENS = 256
+
+
+def _max_tokens_for(text: str) -> int:
+    """
+    Heuristic cap on the tokens of an answer about the given text.
+
+    The prompts ask to reason step by step on the text and then to rewrite 
+    it, or to explain its conflicts, so the answer is not expected to be much 
+    longer than the text: the cap grows with the length of the text (with a 
+    floor for short texts), up to MAX_TOKENS.
+    """
+    return min(MAX_TOKENS, max(MIN_MAX_TOKENS, 2 * len(text)))
+
+
+def make_llm_call(
+    text: str, 
+    expected: str = "", 
+    attempts: int = 3, 
+    max_tokens: int = MAX_TOKENS, 
+    validate: Union[Callable[[str], bool], None] = None, 
+    stop_early: bool = False
+) -> str:
     """    
     Makes a call to a specified LLM provider to obtain a response.
 
+    The responses accepted by `validate` (e.g. the ones that can be parsed) 
+    are cached in memory, so that the same prompt sent again to the same 
+    model is answered without a new call. Without `validate`, the responses 
+    are not cached.
+
     Args:
         text (str): The input text to send to the LLM.
         expected (str, optional): A substring that the response is expected 
             to contain. Defaults to "".
         attempts (int, optional): The number of attempts to make if the 
             first response does not meet expectations. Defaults to 3.
+        max_tokens (int, optional): The maximum number of tokens generated 
+            by the LLM (OpenAI only). Defaults to MAX_TOKENS.
+        validate (Union[Callable[[str], bool], None], optional): A function 
+            telling whether a response can be cached. Defaults to None.
+        stop_early (bool, optional): Whether to stop reading the answer at 
+            the first closing tag of `expected` (OpenAI only), see 
+            `_read_stream`. Defaults to False.
 
     Returns:
-        str: The response content from the LLM. If none of the attempts 
-            yield a response containing the expected substring, 
-            it returns the last response content obtained or an empty string 
-            if no response was received.
+        str: The response content from the LLM. If none of the attempts
+            yield a response containing the expected substring (and, for
+            an opening tag, its closing tag, which is missing in the
+            answers truncated at `max_tokens`), it returns the last
+            response content obtained or an empty string if no response
+            was received.
     """    
-    # TODO. Add support for other LLM providers. 
-    # TODO. More customizations. 
-    # TODO. Better expected checks (not only strings).
-    #text = text.replace("\n", " ")
-    llm_provider = os.getenv("LLM_PROVIDER")
+    llm_provider = get_setting("LLM_PROVIDER")
+    model = get_setting("OPEN_API_MODEL") if llm_provider == "OPENAI" \
+        else get_setting("OLLAMA_MODEL")
+    key = hashlib.blake2b(
+        f"{llm_provider}|{model}|{text}".encode(), digest_size=16
+    ).digest()
+    response_content = LLM_RESPONSE_CACHE.get(key)
+    if (response_content is not None) and \
+        _answer_complete(response_content, expected):
+        logger.debug("LLM ANSWER (cached): %s", response_content)
+        return response_content
+    response_content = _make_llm_call(
+        text=text, 
+        expected=expected, 
+        attempts=attempts, 
+        max_tokens=max_tokens, 
+        stop_early=stop_early
+    )
+    if (validate is not None) and \
+        _answer_complete(response_content, expected) and \
+        validate(response_content):
+        LLM_RESPONSE_CACHE.put(key, response_content)
+    return response_content
+
+
+def _openai_call(
+    text: str, 
+    expected: str = "", 
+    attempts: int = 3, 
+    max_tokens: int = MAX_TOKENS, 
+    stop_early: bool = False
+) -> str:
+    """
+    Make the calls of `make_llm_call` to OpenAI, without caching.
+    """
     response_content = ""
+    client = _openai_client(get_setting("OPENAI_API_KEY"))
+    for _ in range(attempts):
+        if _ > 0:
+            logger.warning(
+                f"Attempt #{_} to obtain an acceptable answer from the LLM."
+            )
+        response = client.chat.completions.create(
+            model=get_setting("OPEN_API_MODEL"),
+            messages=[
+                {
+                    "role": "user", 
+                    "content": [
+                        {
+                            "type": "text", 
+                            "text": text
+                        }
+                    ]
+                }
+            ],
+            temperature=1,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        response_content = _read_stream(
+            response, expected=expected, stop_early=stop_early
+        )
+        logger.debug("LLM ANSWER: %s", response_content)
+        if _answer_complete(response_content, expected):
+            return response_content
+    return response_content
+
 
-    logger.debug("LLM CALL: " + text)
-
-    if llm_provider == "OPENAI":
-        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        for _ in range(attempts):
-            if _ > 0:
-                logger.warning(
-                    f"Attempt #{_} to obtain an acceptable answer from the LLM."
-                )
-            response = client.chat.completions.create(
-                model=os.getenv('OPEN_API_MODEL'),
-                messages=[
-                    {
-                        "role": "user", 
-                        "content": [
-                            {
-                                "type": "text", 
-                                "text": text
-                            }
-                        ]
-                    }
-                ],
-                temperature=1,
-                max_tokens=2048,
-                top_p=1,
-                frequency_penalty=0,
-                presence_penalty=0,
-                response_format={"type": "text"},
+def _ollama_call(
+    text: str, 
+    expected: str = "", 
+    attempts: int = 3, 
+    max_tokens: int = MAX_TOKENS, 
+    stop_early: bool = False
+) -> str:
+    """
+    Make the calls of `make_llm_call` to Ollama, without caching. The 
+    `max_tokens` and `stop_early` arguments are not used.
+    """
+    response_content = ""
+    for _ in range(attempts):
+        if _ > 0:
+            logger.warning(
+                f"Attempt #{_} to obtain an acceptable answer from the LLM."
             )
-            response_content = response.choices[0].message.content
-            logger.debug("LLM ANSWER: " + response_content)
-            if expected in response_content:
-                return response_content
-
-    elif llm_provider == "OLLAMA":
-        for _ in range(attempts):
-            if _ > 0:
-                logger.warning(
-                    f"Attempt #{_} to obtain an acceptable answer from the LLM."
-                )
-            response_content = ollama_chat(
-                model = os.getenv("OLLAMA_MODEL"),
-                messages = [
-                    {
-                        "role": "user", 
-                        "content": text,
-                    },
-                ]
-            )["message"]["content"]
-            logger.debug("LLM ANSWER: " + response_content)
-            if expected in response_content:
-                return response_content
-    
+        response_content = ollama_chat(
+            model = get_setting("OLLAMA_MODEL"),
+            messages = [
+                {
+                    "role": "user", 
+                    "content": text,
+                },
+            ]
+        )["message"]["content"]
+        logger.debug("LLM ANSWER: %s", response_content)
+        if _answer_complete(response_content, expected):
+            return response_content
     return response_content
 
 
+# Calls to each LLM provider, by LLM_PROVIDER.
+# TODO. Add support for other LLM providers. 
+_LLM_CALLS = {
+    "OPENAI": _openai_call,
+    "OLLAMA": _ollama_call,
+}
+
+
+def _make_llm_call(
+    text: str, 
+    expected: str = "", 
+    attempts: int = 3, 
+    max_tokens: int = MAX_TOKENS, 
+    stop_early: bool = False
+) -> str:
+    """
+    Make the calls of `make_llm_call` to the LLM provider, without caching.
+    """
+    # TODO. More customizations. 
+    # TODO. Better expected checks (not only strings).
+    #text = text.replace("\n", " ")
+    logger.debug("LLM CALL: %s", text)
+    llm_provider = get_setting("LLM_PROVIDER")
+    llm_call = _LLM_CALLS.get(llm_provider)
+    if llm_call is None:
+        logger.warning(f"Unknown LLM_PROVIDER {llm_provider}. No LLM call made.")
+        return ""
+    return llm_call(
+        text=text, 
+        expected=expected, 
+        attempts=attempts, 
+        max_tokens=max_tokens, 
+        stop_early=stop_early
+    )
+
+
+@lru_cache(maxsize=32)
+def _compile_output_pattern(pattern: str) -> re.Pattern:
+    """
+    Compile an output pattern once, the same few patterns are used by every 
+    LLM call.
+    """
+    return re.compile(pattern, re.DOTALL)
+
+
 def parse_output(
     text: str, 
     pattern: str = r'\<OUTPUT\>\s*(.*?)\s*\</OUTPUT\>'
@@ -144,7 +660,7 @@ def parse_output(
         str: The extracted text found within the specified pattern. 
             Returns an empty string if no matches are found.
     """
-    matches = re.findall(pattern, text, re.DOTALL)
+    matches = _compile_output_pattern(pattern).findall(text)
     if matches:
         extracted_text = matches[-1].strip()
         return extracted_text 
@@ -155,6 +671,47 @@ def parse_output(
     return ""
     
 
+@lru_cache(maxsize=32)
+def _output_validator(pattern: str) -> Callable[[str], bool]:
+    """
+    Return a function telling whether an LLM response contains an output 
+    matching the given pattern, used to cache only the parsable responses.
+    """
+    compiled_pattern = _compile_output_pattern(pattern)
+    return lambda text: compiled_pattern.search(text) is not None
+
+
+def _correct_conflicts(raw_output: str, parsed_output: str) -> dict:
+    """
+    Check an LLM output for conflicts and correct it if any is found.
+
+    The conflict detection needs the parsed output, and the correction needs 
+    the detected conflicts, so the two calls are necessarily sequential. 
+    Outputs with less than two sentences skip both calls (see 
+    `llm_conflicts_detect`).
+
+    Args:
+        raw_output (str): The raw output of the first LLM call.
+        parsed_output (str): The output parsed from `raw_output`.
+
+    Returns:
+        dict: A dictionary with the "raw_output" (including the one of the 
+            correction, if any) and the final "parsed_output".
+    """
+    conflicts = llm_conflicts_detect(parsed_output)["parsed_output"]
+    if conflicts:
+        dict_corrected_output = llm_correct(
+            text=parsed_output, 
+            comment=conflicts
+        )
+        raw_output = raw_output + dict_corrected_output["raw_output"]
+        parsed_output = dict_corrected_output["parsed_output"]
+    return {
+        "raw_output": raw_output,
+        "parsed_output": parsed_output
+    }
+
+
 def llm_text_rewrite(
     text: str, 
     expected: str = "<OUTPUT>", 
@@ -185,28 +742,103 @@ def llm_text_rewrite(
             - "parsed_output" (str): The extracted and potentially corrected 
               output from the raw response.
     """
+    dict_output = _llm_rewrite_uncorrected(
+        text=text, expected=expected, pattern=pattern
+    )
+    return _correct_conflicts(
+        dict_output["raw_output"], dict_output["parsed_output"]
+    )
+
+
+def _llm_rewrite_uncorrected(
+    text: str, 
+    expected: str = "<OUTPUT>", 
+    pattern: str = r'\<OUTPUT\>\s*(.*?)\s*\</OUTPUT\>'
+) -> dict:
+    """
+    Make the rewrite call of `llm_text_rewrite`, without checking the output 
+    for conflicts.
+    """
     raw_output = make_llm_call(
-        text=PROMPT_KBB_REWRITE % (text), 
-        expected=expected
+        text=_fill_prompt(_PROMPT_PARTS_REWRITE, text), 
+        expected=expected, 
+        max_tokens=_max_tokens_for(text), 
+        validate=_output_validator(pattern)
     )
     parsed_output = parse_output(
             text= raw_output,
             pattern=pattern
         )
-    conflicts = llm_conflicts_detect(parsed_output)["parsed_output"]
-    if conflicts:
-        dict_corrected_output = llm_correct(
-            text=parsed_output, 
-            comment=conflicts
-        )
-        raw_output = raw_output + dict_corrected_output["raw_output"]
-        parsed_output = dict_corrected_output["parsed_output"]
     return {
         "raw_output": raw_output,
         "parsed_output": parsed_output
     }
 
 
+def llm_text_rewrite_batch(
+    texts: List[str], 
+    expected: str = "<OUTPUT>", 
+    pattern: str = r'\<OUTPUT\>\s*(.*?)\s*\</OUTPUT\>',
+    max_workers: int = 8
+) -> List[dict]:
+    """
+    Rewrite several texts using a language model, with concurrent calls.
+
+    This function works as `llm_text_rewrite` on each of the given texts, but 
+    the calls to the language model are sent concurrently, so that rewriting 
+    N texts takes about as long as rewriting the slowest one. The outputs are 
+    checked for conflicts all together with `llm_conflicts_detect_batch`, and 
+    the ones with conflicts are then corrected concurrently.
+
+    Args:
+        texts (List[str]): The input texts that need to be rewritten.
+        expected (str, optional): A tag indicating the expected output format. 
+            Defaults to "<OUTPUT>".
+        pattern (str, optional): A regular expression pattern to identify the 
+            output in the response. 
+            Defaults to r'\<OUTPUT\>\s*(.*?)\s*\</OUTPUT\>'.
+        max_workers (int, optional): The maximum number of concurrent calls. 
+            Defaults to 8.
+
+    Returns:
+        List[dict]: For each input text, in the same order, a dictionary as 
+            returned by `llm_text_rewrite`.
+    """
+    if len(texts) <= 1:
+        return [
+            llm_text_rewrite(text=text, expected=expected, pattern=pattern) 
+            for text in texts
+        ]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(texts))) as executor:
+        list_outputs = list(executor.map(
+            lambda text: _llm_rewrite_uncorrected(
+                text=text, expected=expected, pattern=pattern
+            ), 
+            texts
+        ))
+        list_conflicts = llm_conflicts_detect_batch(
+            texts=[_["parsed_output"] for _ in list_outputs], 
+            expected=expected, 
+            pattern=pattern
+        )
+        dict_futures = {
+            i: executor.submit(
+                llm_correct, 
+                text=list_outputs[i]["parsed_output"], 
+                comment=conflicts
+            )
+            for i, conflicts in enumerate(list_conflicts) if conflicts
+        }
+        for i, future in dict_futures.items():
+            dict_corrected_output = future.result()
+            list_outputs[i] = {
+                "raw_output": list_outputs[i]["raw_output"] + \
+                    dict_corrected_output["raw_output"],
+                "parsed_output": dict_corrected_output["parsed_output"]
+            }
+    return list_outputs
+
+
 def llm_text_remove(
     text1: str, text2: str, 
     expected: str = "<OUTPUT>", 
@@ -239,25 +871,40 @@ def llm_text_remove(
               output from the raw response.
     """
     raw_output = make_llm_call(
-        text=PROMPT_KBB_SUB % (text1, text2), 
-        expected=expected
+        text=_fill_prompt(_PROMPT_PARTS_SUB, text1, text2), 
+        expected=expected, 
+        max_tokens=_max_tokens_for(text1), 
+        validate=_output_validator(pattern)
     )
     parsed_output = parse_output(
             text= raw_output,
             pattern=pattern
         )
-    conflicts = llm_conflicts_detect(parsed_output)["parsed_output"]
-    if conflicts:
-        dict_corrected_output = llm_correct(
-            text=parsed_output, 
-            comment=conflicts
-        )
-        raw_output = raw_output + dict_corrected_output["raw_output"]
-        parsed_output = dict_corrected_output["parsed_output"]
-    return {
-        "raw_output": raw_output,
-        "parsed_output": parsed_output
-    }
+    return _correct_conflicts(raw_output, parsed_output)
+
+
+# A text with less than two sentences (split on these terminators) cannot 
+# contain conflicting statements, so it is not sent to the LLM.
+_SENTENCE_END = re.compile(r'[.!?\n]+')
+
+# LLM answers stating that no conflicts were found.
+_NO_CONFLICT = re.compile(r'no (evident )?contradict')
+
+
+def _may_conflict(text: str) -> bool:
+    """
+    Whether a text has at least two sentences, and so may contain conflicts.
+    """
+    list_sentences = [_ for _ in _SENTENCE_END.split(text) if _.strip()]
+    return len(list_sentences) >= 2
+
+
+def _is_no_conflict(verdict: str) -> bool:
+    """
+    Whether an LLM verdict states that no conflicts were found.
+    """
+    return (verdict == "OK") or \
+        (_NO_CONFLICT.search(verdict.lower()) is not None)
 
 
 def llm_conflicts_detect(
@@ -271,7 +918,8 @@ def llm_conflicts_detect(
     This function utilizes a language model to analyze the input text for any 
     conflicting statements or contradictions. If no conflicts are detected, it 
     returns a result indicating that there are no issues. If potential conflicts 
-    are found, it logs a warning and returns the details of the conflicts.
+    are found, it logs a warning and returns the details of the conflicts. 
+    Texts with less than two sentences are not sent to the language model.
 
     Args:
         text (str): The input text to be analyzed for conflicts.
@@ -291,18 +939,22 @@ def llm_conflicts_detect(
                 - or the parsed output string containing details of potential 
                   conflicts if any are detected.
     """
+    if not _may_conflict(text):
+        return {
+            "raw_output": "", 
+            "parsed_output": False
+        }
     raw_output = make_llm_call(
-        text=PROMPT_KBB_CONFLICTS % (text), 
-        expected=expected
+        text=_fill_prompt(_PROMPT_PARTS_CONFLICTS, text), 
+        expected=expected, 
+        max_tokens=_max_tokens_for(text), 
+        validate=_output_validator(pattern)
     )
     parsed_output = parse_output(
         text=raw_output,
         pattern=pattern
     )
-    if (parsed_output == "OK") or \
-        ("no contradiction" in parsed_output) or \
-        ("no evident contradictory" in parsed_output) or \
-        ("no contradictory" in parsed_output):
+    if _is_no_conflict(parsed_output):
         return {
             "raw_output": raw_output, 
             "parsed_output": False
@@ -315,6 +967,112 @@ def llm_conflicts_detect(
         }
     
 
+def _parse_verdicts(
+    raw_output: str, 
+    pattern: str = r'\<OUTPUT\>\s*(.*?)\s*\</OUTPUT\>'
+) -> Union[Dict[int, str], None]:
+    """
+    Parse the JSON list of verdicts answered to a batched conflict detection.
+
+    Args:
+        raw_output (str): The raw output of the language model.
+        pattern (str, optional): A regular expression pattern to identify the 
+            output in the response. 
+            Defaults to r'\<OUTPUT\>\s*(.*?)\s*\</OUTPUT\>'.
+
+    Returns:
+        Union[Dict[int, str], None]: The verdicts keyed by block index, 
+            without the missing or non-string ones, or None if the output 
+            cannot be parsed.
+    """
+    matches = _compile_output_pattern(pattern).findall(raw_output)
+    if not matches:
+        return None
+    dict_verdicts = {}
+    try:
+        for item in orjson.loads(matches[-1].strip()):
+            verdict = item.get("verdict")
+            # Verdicts that are missing or not strings (e.g. null) are left 
+            # out, so that their texts are checked one by one.
+            if isinstance(verdict, str) and verdict.strip():
+                dict_verdicts[int(item["i"])] = verdict.strip()
+    except (orjson.JSONDecodeError, AttributeError, KeyError, TypeError, ValueError):
+        return None
+    return dict_verdicts
+
+
+def llm_conflicts_detect_batch(
+    texts: List[str], 
+    expected: str = "<OUTPUT>", 
+    pattern: str = r'\<OUTPUT\>\s*(.*?)\s*\</OUTPUT\>', 
+    max_texts: int = 8
+) -> List[Union[bool, str]]:
+    """
+    Detect potential conflicts in several texts with a single language model 
+    call for up to `max_texts` texts.
+
+    The texts are sent in the same prompt, each one enclosed in its own block 
+    tags, and the language model answers with a JSON list of verdicts, one 
+    per block. If the answer cannot be parsed, or a verdict is missing, the 
+    texts concerned are checked one by one with `llm_conflicts_detect`. 
+    Texts with less than two sentences are not sent to the language model.
+
+    Args:
+        texts (List[str]): The input texts to be analyzed for conflicts.
+        expected (str, optional): A tag indicating the expected output format. 
+            Defaults to "<OUTPUT>".
+        pattern (str, optional): A regular expression pattern to identify the 
+            output in the response. 
+            Defaults to r'\<OUTPUT\>\s*(.*?)\s*\</OUTPUT\>'.
+        max_texts (int, optional): The maximum number of texts sent in a 
+            single prompt. Defaults to 8.
+
+    Returns:
+        List[Union[bool, str]]: For each input text, in the same order, 
+            `False` if no conflicts are found or the details of the potential 
+            conflicts, as the "parsed_output" of `llm_conflicts_detect`.
+    """
+    list_verdicts: List[Union[bool, str]] = [False] * len(texts)
+    list_indexes = [i for i, text in enumerate(texts) if _may_conflict(text)]
+    if len(list_indexes) == 1:
+        i = list_indexes[0]
+        list_verdicts[i] = llm_conflicts_detect(
+            text=texts[i], expected=expected, pattern=pattern
+        )["parsed_output"]
+        return list_verdicts
+    for start in range(0, len(list_indexes), max_texts):
+        list_chunk = list_indexes[start:start + max_texts]
+        blocks = "\n".join(
+            f"<BLOCK {j}>\n{texts[i]}\n</BLOCK {j}>" 
+            for j, i in enumerate(list_chunk)
+        )
+        raw_output = make_llm_call(
+            text=_fill_prompt(_PROMPT_PARTS_CONFLICTS_BATCH, blocks), 
+            expected=expected, 
+            max_tokens=min(
+                MAX_TOKENS, sum(_max_tokens_for(texts[i]) for i in list_chunk)
+            ), 
+            validate=lambda text: _parse_verdicts(text, pattern) is not None
+        )
+        dict_verdicts = _parse_verdicts(raw_output, pattern)
+        if dict_verdicts is None:
+            logger.warning(
+                f"Unparsable conflicts verdicts. Checking the texts one by one. " + \
+                f"Unparsed output: {raw_output}"
+            )
+            dict_verdicts = {}
+        for j, i in enumerate(list_chunk):
+            verdict = dict_verdicts.get(j)
+            if verdict is None:
+                list_verdicts[i] = llm_conflicts_detect(
+                    text=texts[i], expected=expected, pattern=pattern
+                )["parsed_output"]
+            elif not _is_no_conflict(verdict):
+                logger.warning(f"Possible conflicts in the text: {verdict}")
+                list_verdicts[i] = verdict
+    return list_verdicts
+
+
 def llm_correct(
     text: str, comment: str, 
     expected: str = "<OUTPUT>", 
@@ -344,8 +1102,10 @@ def llm_correct(
             - "parsed_output"  (str): The corrected string.
     """
     raw_output = make_llm_call(
-        text=PROMPT_KBB_CORRECT % (text, comment), 
-        expected=expected
+        text=_fill_prompt(_PROMPT_PARTS_CORRECT, text, comment), 
+        expected=expected, 
+        max_tokens=_max_tokens_for(text), 
+        validate=_output_validator(pattern)
     )
     parsed_output = parse_output(
         text=raw_output,
@@ -166,4 +166,36 @@ Reasoning:
 ...
 The output is:
 
-'''
\ No newline at end of file
+'''
+
+PROMPT_KBB_CONFLICTS_BATCH = '''
+
+- I have several blocks of text, each one enclosed within <BLOCK i> </BLOCK i> tags, where i is the index of the block. 
+- For each block independently, I need you to identify evident conflictual information or strong contradictory statements within it. 
+- Please highlight the specific conflicting statements and provide a brief explanation of why they are considered contradictory. 
+- Ensure that the identified conflicts are based on clear evidence from the given block and not on assumptions or hypotheses or your previous knowledge.
+- Do not use any your previous knowledge. Do not compare different blocks. Use only the contents of each block. 
+- If no evident conflictual information or contradictory statements are detected in a block, or if you are unsure, then its verdict is OK.
+- Please return a JSON list with one verdict per block, enclosed within <OUTPUT> </OUTPUT> tags. For example, it should be formatted as follows: <OUTPUT>[{"i": 0, "verdict": "OK"}, {"i": 1, "verdict": "Explanation of the conflict."}]</OUTPUT>
+- Reason step by step. 
+
+Example 1. 
+**Blocks:**
+<BLOCK 0>
+I am hungry right now and the pen is red. 
+I am full and won't eat again today.
+</BLOCK 0>
+<BLOCK 1>
+Intesa Sanpaolo is an Italian bank. It has its headquarter in Turin. 
+Turin is a city on the north of Italy and it is where the headquarter of Intesa Sanpaolo is located.
+</BLOCK 1>
+Reasoning: in the block 0 I am hungry in the first sentence but in the second sentence I say that I won't eat again because I am full. No contradictory statements in the block 1.
+The output is: <OUTPUT>[{"i": 0, "verdict": "In the first sentence I am hungry but in the second sentence I say that I won't eat again because I am full. They are contradictory statements."}, {"i": 1, "verdict": "OK"}]</OUTPUT>
+
+Your turn to complete.
+**Blocks:**
+%s
+Reasoning: ...
+The output is:
+
+'''